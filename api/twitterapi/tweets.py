@@ -1,7 +1,10 @@
 from dataclasses import dataclass
+from datetime import datetime
 
 import requests
 import os
+from urllib.parse import urlparse
+from tracing import span
 
 TWITTERAPI_API_KEY = os.getenv("TWITTERAPI_API_KEY")
 
@@ -97,26 +100,36 @@ class Tweet:
                 in_reply_to_username=data["inReplyToUsername"],
             )
 
+    @property
+    def created_at_timestamp(self) -> float:
+        # createdAt uses Twitter's format, e.g. "Tue Dec 10 07:00:30 +0000 2024"
+        return datetime.strptime(self.created_at, "%a %b %d %H:%M:%S %z %Y").timestamp()
+
 def twitterapi_get(url):
-    try:
-        response = requests.get(url, headers={"x-api-key": TWITTERAPI_API_KEY})
-        response.raise_for_status()
-        return response
+    with span("twitterapi.get", path=urlparse(url).path) as current:
+        try:
+            response = requests.get(url, headers={"x-api-key": TWITTERAPI_API_KEY})
+            current.set(status_code=response.status_code, response_bytes=len(response.content))
+            response.raise_for_status()
+            return response
         
-    except requests.exceptions.HTTPError as http_err:
-        print(f"HTTP error occurred: {http_err}")
-        if response.status_code == 429:
-            print("Rate limit exceeded. Consider implementing backoff.")
-        elif response.status_code == 401:
-            print("Authentication error. Check your API key.")
-        elif response.status_code == 404:
-            print(f"Resourcenot found.")
-        return None
+        except requests.exceptions.HTTPError as http_err:
+            print(f"HTTP error occurred: {http_err}")
+            current.fail(http_err)
+            if response.status_code == 429:
+                print("Rate limit exceeded. Consider implementing backoff.")
+            elif response.status_code == 401:
+                print("Authentication error. Check your API key.")
+            elif response.status_code == 404:
+                print(f"Resourcenot found.")
+            return None
         
-    except requests.exceptions.RequestException as err:
-        print(f"Error occurred while making request: {err}")
-        return None
+        except requests.exceptions.RequestException as err:
+            print(f"Error occurred while making request: {err}")
+            current.fail(err)
+            return None
         
-    except ValueError as err:  # Includes JSONDecodeError
-        print(f"Error parsing JSON response: {err}")
-        return None
+        except ValueError as err:  # Includes JSONDecodeError
+            print(f"Error parsing JSON response: {err}")
+            current.fail(err)
+            return None
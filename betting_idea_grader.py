@@ -1,15 +1,33 @@
-from datetime import datetime
+import asyncio
+from datetime import datetime, timezone
 import os
+import time
 from typing import Literal, Optional
 from pydantic import BaseModel, Field
-from langchain_openai import ChatOpenAI
-from langchain_community.chat_models import ChatPerplexity
 from langchain_core.messages import SystemMessage, HumanMessage
 from langgraph.graph import END, START, MessagesState, StateGraph
-from langchain_community.tools.tavily_search import TavilySearchResults
 from betting_pool_generator import BettingPoolGeneratorOutput
-from common import smol_llm
-from common import big_llm
+from common import get_big_llm, get_cached_big_llm, lazy
+from db.evidence_store import EvidenceStore, content_hash
+from provider_limits import async_provider_slot
+from tools.context_builder import build_context
+from tools.search_cache import cached_tavily_search
+
+# Max concurrent search/summary calls per gather_evidence run, and the seconds to wait for each one
+EVIDENCE_CONCURRENCY = int(os.getenv("EVIDENCE_CONCURRENCY", 6))
+EVIDENCE_CALL_TIMEOUT = float(os.getenv("EVIDENCE_CALL_TIMEOUT", 60))
+# Max age in seconds of a cached search result used as evidence. Kept short so grading sees recent results
+GRADER_SEARCH_CACHE_TTL = int(os.getenv("GRADER_SEARCH_CACHE_TTL", 300))
+# Token budget for the page content in each evidence summary prompt
+EVIDENCE_CONTEXT_TOKENS = int(os.getenv("EVIDENCE_CONTEXT_TOKENS", 1500))
+# Seconds after which a stored source found again is summarized again, even if its content looks unchanged
+EVIDENCE_RESUMMARIZE_AFTER = int(os.getenv("EVIDENCE_RESUMMARIZE_AFTER", 6 * 60 * 60))
+# Stored evidence and queries older than this many seconds are dropped
+EVIDENCE_MAX_AGE = int(os.getenv("EVIDENCE_MAX_AGE", 7 * 24 * 60 * 60))
+# Seconds between sweeps for expired evidence in a process, rather than one per grading run
+EVIDENCE_EXPIRE_INTERVAL = int(os.getenv("EVIDENCE_EXPIRE_INTERVAL", 60 * 60))
+# Re-grades that reuse a pool's search queries before new ones are generated
+EVIDENCE_QUERY_MAX_REUSES = int(os.getenv("EVIDENCE_QUERY_MAX_REUSES", 3))
 
 
 class EvidenceSearchQueries(BaseModel):
@@ -22,6 +40,7 @@ class BettingPoolIdeaGraderOutput(BaseModel):
     sources: list[str]
     explanation: str
     time_period_analysis: Optional[dict] = Field(default_factory=dict)
+    next_check_datetime: Optional[str] = None
 
 
 class Evidence(BaseModel):
@@ -32,19 +51,38 @@ class Evidence(BaseModel):
 
 
 class BettingPoolIdeaGraderGraphOutput(MessagesState):
+    # Set when grading an existing pool, so evidence from earlier runs is reused
+    pool_id: Optional[str]
     betting_pool_idea: BettingPoolGeneratorOutput
     evidence_search_queries: list[str]
     evidence: list[Evidence]
     betting_pool_idea_result: BettingPoolIdeaGraderOutput
 
 
-tavily_search = TavilySearchResults(
-    max_results=2,
-    include_answer=True,
-    include_raw_content=True,
-    include_images=False,
-    # search_depth="advanced", # Unclear what this does
-)
+_evidence_expired_at = 0.0
+
+
+def load_stored_evidence(pool_id):
+    """Returns the pool's stored evidence keyed by URL, first dropping expired evidence if it's time to"""
+    global _evidence_expired_at
+    evidence_store = EvidenceStore()
+    if time.time() - _evidence_expired_at >= EVIDENCE_EXPIRE_INTERVAL:
+        _evidence_expired_at = time.time()
+        evidence_store.expire(EVIDENCE_MAX_AGE)
+    return {item["url"]: item for item in evidence_store.get_evidence(pool_id)}
+
+
+@lazy
+def get_tavily_search():
+    from langchain_community.tools.tavily_search import TavilySearchResults
+
+    return TavilySearchResults(
+        max_results=2,
+        include_answer=True,
+        include_raw_content=True,
+        include_images=False,
+        # search_depth="advanced", # Unclear what this does
+    )
 
 
 def betting_pool_grading_preamble(betting_pool: dict):
@@ -63,7 +101,7 @@ def betting_pool_grading_preamble(betting_pool: dict):
     - Condition in which "no" will lose: {betting_pool['options']['no']['lose_condition']}"""
 
 
-def generate_evidence_queries(state: BettingPoolIdeaGraderGraphOutput):
+async def generate_evidence_queries(state: BettingPoolIdeaGraderGraphOutput):
     """Grade the betting pool idea"""
     print(f"state in generate_evidence_queries: {state}")
     print("Grading betting pool idea")
@@ -71,6 +109,28 @@ def generate_evidence_queries(state: BettingPoolIdeaGraderGraphOutput):
     betting_pool = state.get("betting_pool_idea")
     print(f"betting_pool in generate_evidence_queries: {betting_pool}")
 
+    # Re-grades reuse a pool's queries for a few checks. They are regenerated after that, and once the decision date
+    # has passed if they were made before it, since what's worth searching for changes as results come out.
+    # The evidence store is sqlite, so it's read and written off the event loop
+    pool_id = state.get("pool_id")
+    if pool_id:
+        evidence_store = await asyncio.to_thread(EvidenceStore)
+        stored_queries = await asyncio.to_thread(evidence_store.get_queries, pool_id)
+        decision_date = betting_pool.get("closure_datetime")
+        stale = stored_queries and (
+            max(query["reuses"] for query in stored_queries) >= EVIDENCE_QUERY_MAX_REUSES
+            or (
+                isinstance(decision_date, (int, float))
+                and decision_date <= datetime.now().timestamp()
+                and min(query["created_at"] for query in stored_queries) < decision_date
+            )
+        )
+        if stored_queries and not stale:
+            search_queries = [query["search_query"] for query in stored_queries]
+            print(f"Reusing evidence search queries for pool {pool_id}: {search_queries}")
+            await asyncio.to_thread(evidence_store.mark_queries_reused, pool_id)
+            return {"evidence_search_queries": search_queries}
+
     evidence_search_sys_msg = SystemMessage(
         content=f"""
     Your task is to generate 3 search queries for finding evidence about the outcome of a betting pool.
@@ -114,15 +174,19 @@ def generate_evidence_queries(state: BettingPoolIdeaGraderGraphOutput):
     """
     )
 
-    structured_llm = big_llm.with_structured_output(EvidenceSearchQueries)
-    result = structured_llm.invoke([evidence_search_sys_msg, evidence_search_user_msg])
+    structured_llm = get_big_llm().with_structured_output(EvidenceSearchQueries)
+    async with async_provider_slot("llm"):
+        result = await structured_llm.ainvoke([evidence_search_sys_msg, evidence_search_user_msg])
     print("Evidence search result:", result)
+    if pool_id:
+        evidence_store = await asyncio.to_thread(EvidenceStore)
+        await asyncio.to_thread(evidence_store.replace_queries, pool_id, result.evidence_search_queries)
     return {
         "evidence_search_queries": result.evidence_search_queries,
     }
 
 
-def gather_evidence(state: BettingPoolIdeaGraderGraphOutput):
+async def gather_evidence(state: BettingPoolIdeaGraderGraphOutput):
     """Gather evidence from search queries"""
     print("Gathering evidence from search queries")
 
@@ -130,6 +194,20 @@ def gather_evidence(state: BettingPoolIdeaGraderGraphOutput):
     search_queries = state.get("evidence_search_queries")
     evidence_list = []
 
+    # Sources already summarized for this pool in earlier runs are not summarized again, unless their content has
+    # changed or the summary is older than EVIDENCE_RESUMMARIZE_AFTER
+    pool_id = state.get("pool_id")
+    stored_evidence = await asyncio.to_thread(load_stored_evidence, pool_id) if pool_id else {}
+    content_hashes = {}
+
+    def is_fresh(doc):
+        stored = stored_evidence.get(doc.get("url"))
+        return (
+            stored is not None
+            and stored["content_hash"] == content_hashes[doc.get("url")]
+            and time.time() - stored["fetched_at"] < EVIDENCE_RESUMMARIZE_AFTER
+        )
+
     search_sys_msg = SystemMessage(
         content=f"""You are a search assistant that finds and summarizes relevant evidence.
         For the given search query, return information from reliable sources.
@@ -153,50 +231,102 @@ def gather_evidence(state: BettingPoolIdeaGraderGraphOutput):
         """
     )
 
-    structured_llm = big_llm.with_structured_output(Evidence)
-
-    for query in search_queries:
+    # Summaries only depend on the pool, query and document, so re-grades reuse them from the LLM cache
+    structured_llm = get_cached_big_llm().with_structured_output(Evidence)
+
+    semaphore = asyncio.Semaphore(EVIDENCE_CONCURRENCY)
+
+    async def search(query):
+        # use tavily to gather evidence
+        async with semaphore:
+            return await asyncio.wait_for(
+                cached_tavily_search(get_tavily_search(), query, ttl=GRADER_SEARCH_CACHE_TTL),
+                EVIDENCE_CALL_TIMEOUT,
+            )
+
+    async def summarize(query, doc):
+        # Only the parts of the page most relevant to the query and the pool are sent for summarizing
+        content, report = build_context(
+            f"{query} {betting_pool.get('betting_pool_idea')}",
+            [
+                {
+                    "title": doc.get("title", ""),
+                    "url": doc.get("url", ""),
+                    "content": doc.get("raw_content") or doc.get("content") or "",
+                }
+            ],
+            EVIDENCE_CONTEXT_TOKENS,
+        )
+        print(f"Evidence context for '{doc.get('url', '')}': {report}")
         search_user_msg = HumanMessage(
             content=f"""
             SEARCH QUERY: {query}
+            
+            SOURCE:
+            {content}
 
-            Please find and analyze relevant evidence for this query in the context of the betting pool.
+            Please analyze and summarize this search result in the context of the betting pool.
             """
         )
-
+        async with semaphore, async_provider_slot("llm"):
+            result = await asyncio.wait_for(
+                structured_llm.ainvoke([search_sys_msg, search_user_msg]), EVIDENCE_CALL_TIMEOUT
+            )
+        if not result.search_query:
+            result.search_query = query
+        if doc.get("url"):
+            result.url = doc["url"]
+        return result
+
+    async def safe_search(query):
         try:
-            # use llm to gather evidence
-            # result = structured_llm.invoke([search_sys_msg, search_user_msg])
-            # if not result.search_query:
-            #     result.search_query = query
-            # evidence_list.append(result)
-
-            # use tavily to gather evidence
-            search_docs = tavily_search.invoke(query)
-            for doc in search_docs:
-                search_user_msg = HumanMessage(
-                    content=f"""
-                    SEARCH QUERY: {query}
-                    
-                    SOURCE URL: {doc.get('url', '')}
-                    CONTENT: {doc.get('content', '')}
-
-                    Please analyze and summarize this search result in the context of the betting pool.
-                    """
-                )
-                result = structured_llm.invoke([search_sys_msg, search_user_msg])
-                if not result.search_query:
-                    result.search_query = query
-                evidence_list.append(result)
+            return await search(query)
         except Exception as e:
-            print(f"Error processing query '{query}': {e}")
-            continue
+            print(f"Error processing query '{query}': {e!r}")
+            return []
+
+    # Searches run concurrently. Their results are deduplicated afterwards in (query, document) order, so which query
+    # a source shared by several queries is credited to, and the evidence list, don't depend on which returns first.
+    search_results = await asyncio.gather(*(safe_search(query) for query in search_queries))
+    seen_urls = set()
+    to_summarize = []
+    for query, search_docs in zip(search_queries, search_results):
+        for doc in search_docs:
+            if doc.get("url") in seen_urls:
+                continue
+            seen_urls.add(doc.get("url"))
+            content_hashes[doc.get("url")] = content_hash(doc.get("raw_content") or doc.get("content") or "")
+            # Skip sources summarized from the same content recently
+            if not is_fresh(doc):
+                to_summarize.append((query, doc))
+
+    summaries = await asyncio.gather(*(summarize(query, doc) for query, doc in to_summarize), return_exceptions=True)
+    for (query, doc), summary in zip(to_summarize, summaries):
+        if isinstance(summary, Exception):
+            print(f"Error summarizing '{doc.get('url', '')}' for query '{query}': {summary!r}")
+        else:
+            evidence_list.append(summary)
+
+    if pool_id:
+        evidence_store = await asyncio.to_thread(EvidenceStore)
+        await asyncio.to_thread(
+            evidence_store.add_evidence,
+            pool_id,
+            [dict(evidence.model_dump(), content_hash=content_hashes.get(evidence.url)) for evidence in evidence_list],
+        )
+        summarized_urls = {evidence.url for evidence in evidence_list}
+        kept_evidence = [item for url, item in stored_evidence.items() if url not in summarized_urls]
+        print(f"Summarized {len(evidence_list)} new or changed sources for pool {pool_id}, {len(kept_evidence)} from earlier runs")
+        evidence_list = [
+            Evidence(url=item["url"], summary=item["summary"], search_query=item["search_query"])
+            for item in kept_evidence
+        ] + evidence_list
 
     print(f"Evidence list: {evidence_list}")
     return {"evidence": evidence_list}
 
 
-def grade_betting_pool_idea(state: BettingPoolIdeaGraderGraphOutput):
+async def grade_betting_pool_idea(state: BettingPoolIdeaGraderGraphOutput):
     """Grade the betting pool idea"""
 
     print("Grading betting pool idea")
@@ -258,16 +388,16 @@ def grade_betting_pool_idea(state: BettingPoolIdeaGraderGraphOutput):
             "period_mentioned": "", // e.g., "Q1 2024"
             "period_has_passed": true/false,
             "official_results_available": true/false
-        }}
+        }},
+        "next_check_datetime": "" // If "not resolved yet", when official results are expected to be available, in ISO 8601 format, UTC. Otherwise an empty string
     }}
     """
     )
 
+    # Ordered from least to most likely to change between runs (the pool, then its evidence, then the time), after the
+    # static instructions above, so re-grades of a pool can reuse the provider's cached prompt prefix
     grading_user_msg = HumanMessage(
         content=f"""
-    EVIDENCE PROVIDED:
-    {evidence_list}
-
     BETTING POOL DETAILS:
     Question: {betting_pool['betting_pool_idea']}
     Options: {betting_pool['options']}
@@ -283,13 +413,17 @@ def grade_betting_pool_idea(state: BettingPoolIdeaGraderGraphOutput):
     
     CLOSURE DATETIME: {datetime.fromtimestamp(betting_pool['closure_datetime']).strftime('%Y-%m-%d %H:%M:%S')}
 
+    EVIDENCE PROVIDED:
+    {evidence_list}
+
     CURRENT DATETIME: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
     """
     )
 
     # TODO Later we'll want to use Claude sonnet here, but not until after we reduce costs
-    structured_llm = big_llm.with_structured_output(BettingPoolIdeaGraderOutput)
-    result = structured_llm.invoke([grading_sys_msg, grading_user_msg])
+    structured_llm = get_big_llm().with_structured_output(BettingPoolIdeaGraderOutput)
+    async with async_provider_slot("llm"):
+        result = await structured_llm.ainvoke([grading_sys_msg, grading_user_msg])
     print("Grading result:", result)
 
     # Determine the result code based on the grading output
@@ -313,21 +447,46 @@ def grade_betting_pool_idea(state: BettingPoolIdeaGraderGraphOutput):
             "sources": result.sources,
             "explanation": result.explanation,
             "time_period_analysis": result.time_period_analysis,
+            "next_check_at": parse_next_check_datetime(result.next_check_datetime),
         }
     }
 
 
-betting_pool_idea_grader = StateGraph(BettingPoolIdeaGraderGraphOutput)
+def parse_next_check_datetime(next_check_datetime):
+    """Unix time of the grader's next check estimate, or None if it gave none or it can't be parsed"""
+    if not next_check_datetime:
+        return None
+    try:
+        parsed = datetime.fromisoformat(next_check_datetime.replace("Z", "+00:00"))
+    except ValueError:
+        print(f"Could not parse next check datetime: {next_check_datetime}")
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+@lazy
+def get_betting_pool_idea_grader_agent():
+    """Build and compile the grader graph on first use"""
+    betting_pool_idea_grader = StateGraph(BettingPoolIdeaGraderGraphOutput)
+
+    betting_pool_idea_grader.add_node(
+        "generate_evidence_queries", generate_evidence_queries
+    )
+    betting_pool_idea_grader.add_node("gather_evidence", gather_evidence)
+    betting_pool_idea_grader.add_node("grade_betting_pool_idea", grade_betting_pool_idea)
+
+    betting_pool_idea_grader.add_edge(START, "generate_evidence_queries")
+    betting_pool_idea_grader.add_edge("generate_evidence_queries", "gather_evidence")
+    betting_pool_idea_grader.add_edge("gather_evidence", "grade_betting_pool_idea")
+    betting_pool_idea_grader.add_edge("grade_betting_pool_idea", END)
 
-betting_pool_idea_grader.add_node(
-    "generate_evidence_queries", generate_evidence_queries
-)
-betting_pool_idea_grader.add_node("gather_evidence", gather_evidence)
-betting_pool_idea_grader.add_node("grade_betting_pool_idea", grade_betting_pool_idea)
+    return betting_pool_idea_grader.compile()
 
-betting_pool_idea_grader.add_edge(START, "generate_evidence_queries")
-betting_pool_idea_grader.add_edge("generate_evidence_queries", "gather_evidence")
-betting_pool_idea_grader.add_edge("gather_evidence", "grade_betting_pool_idea")
-betting_pool_idea_grader.add_edge("grade_betting_pool_idea", END)
 
-betting_pool_idea_grader_agent = betting_pool_idea_grader.compile()
+def __getattr__(name):
+    # `betting_pool_idea_grader_agent` is compiled on first access
+    if name == "betting_pool_idea_grader_agent":
+        return get_betting_pool_idea_grader_agent()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
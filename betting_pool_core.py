@@ -1,5 +1,4 @@
 from datetime import datetime, timedelta
-from web3 import Web3
 import os
 import json
 import urllib.parse
@@ -7,7 +6,13 @@ from dotenv import load_dotenv
 from db.redis import get_redis_client
 import requests
 from twitter_post import post_tweet_using_redis_token
-from eth_account import Account
+from common import lazy
+from tx_manager import TransactionManager
+from provider_limits import provider_slot
+from subgraph import POOL_FIELDS, iter_pending_pools
+from grading_schedule import add_pools
+from instrumentation import get_callbacks
+from tracing import span, trace_web3_provider
 
 # Load environment variables
 load_dotenv()
@@ -18,22 +23,63 @@ CONTRACT_ADDRESS = os.getenv("CONTRACT_ADDRESS")
 PRIVATE_KEY = os.getenv("PRIVATE_KEY")
 GAS_LIMIT = int(os.getenv("GAS_LIMIT", 3000000))
 SUBGRAPH_URL = os.getenv("SUBGRAPH_URL")
-
-# Initialize Web3
-w3 = Web3(Web3.HTTPProvider(WEB3_NODE_URL))
+# Target gas for a single claimPayouts transaction, and the safety margin applied on top of estimates
+PAYOUT_GAS_BUDGET = int(os.getenv("PAYOUT_GAS_BUDGET", 2500000))
+PAYOUT_GAS_MARGIN = float(os.getenv("PAYOUT_GAS_MARGIN", 1.25))
+PAYOUT_GAS_SAMPLE_SIZE = int(os.getenv("PAYOUT_GAS_SAMPLE_SIZE", 10))
+# Used when claimPayouts can't be estimated, e.g. because the pool hasn't been closed on chain yet
+PAYOUT_GAS_PER_BET_FALLBACK = int(os.getenv("PAYOUT_GAS_PER_BET_FALLBACK", 60000))
 
 # Get the directory where the current script is located
 script_dir = os.path.dirname(os.path.abspath(__file__))
 abi_path = os.path.join(script_dir, "BettingPools.json")
 
-# Load contract ABI from JSON file
-with open(abi_path, "r") as abi_file:
-    abi_data = json.load(abi_file)
-    CONTRACT_ABI = abi_data["abi"]
 
-# Initialize contract
-CONTRACT = w3.eth.contract(address=CONTRACT_ADDRESS, abi=CONTRACT_ABI)
-ACCOUNT = w3.eth.account.from_key(PRIVATE_KEY)
+# web3 and the contract ABI are slow to import and parse, so they are only loaded by the processes that send transactions
+@lazy
+def get_w3():
+    from web3 import Web3
+
+    return Web3(trace_web3_provider(Web3.HTTPProvider(WEB3_NODE_URL)))
+
+
+@lazy
+def get_contract_abi():
+    # Load contract ABI from JSON file
+    with open(abi_path, "r") as abi_file:
+        abi_data = json.load(abi_file)
+        return abi_data["abi"]
+
+
+@lazy
+def get_contract():
+    return get_w3().eth.contract(address=CONTRACT_ADDRESS, abi=get_contract_abi())
+
+
+@lazy
+def get_account():
+    return get_w3().eth.account.from_key(PRIVATE_KEY)
+
+
+@lazy
+def get_tx_manager():
+    return TransactionManager(get_w3(), get_account())
+
+
+_LAZY_ATTRIBUTES = {
+    "w3": get_w3,
+    "CONTRACT_ABI": get_contract_abi,
+    "CONTRACT": get_contract,
+    "ACCOUNT": get_account,
+    "TX_MANAGER": get_tx_manager,
+}
+
+
+def __getattr__(name):
+    # Keeps the old module-level names working, built on first access
+    if name in _LAZY_ATTRIBUTES:
+        return _LAZY_ATTRIBUTES[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def generate_twitter_intent_url(text):
@@ -50,12 +96,15 @@ async def call_langgraph_agent(agent, message_text=None, original_text=None):
 
     try:
         print(f"Calling Langgraph agent with message in betting_pool_core: {message}")
-        agent_response = agent.invoke(
-            {
-                "messages": [message],
-                "prefer_fast_response": True,
-            }
-        )
+        # The graph's nodes are async, so it runs on the caller's event loop without blocking it
+        with span("generator.agent"):
+            agent_response = await agent.ainvoke(
+                {
+                    "messages": [message],
+                    "prefer_fast_response": True,
+                },
+                config={"callbacks": get_callbacks("generator")},
+            )
         print(f"Agent response in betting_pool_core: {agent_response}")
         return agent_response
     except Exception as e:
@@ -65,33 +114,25 @@ async def call_langgraph_agent(agent, message_text=None, original_text=None):
 def create_pool(pool_data):
     pool_id = None
     try:
-        tx = CONTRACT.functions.createPool(
-            (
-                pool_data["question"],
-                pool_data["options"],
-                pool_data["betsCloseAt"],
-                pool_data["decisionDate"],
-                pool_data["imageUrl"],
-                pool_data["category"],
-                pool_data["creatorName"],
-                pool_data["creatorId"],
-                pool_data["closureCriteria"],
-                pool_data["closureInstructions"],
-            )
-        ).build_transaction(
-            {
-                "from": ACCOUNT.address,
-                "nonce": w3.eth.get_transaction_count(ACCOUNT.address),
-                "gas": GAS_LIMIT,
-                "gasPrice": w3.eth.gas_price,
-            }
+        receipt = get_tx_manager().transact(
+            get_contract().functions.createPool(
+                (
+                    pool_data["question"],
+                    pool_data["options"],
+                    pool_data["betsCloseAt"],
+                    pool_data["decisionDate"],
+                    pool_data["imageUrl"],
+                    pool_data["category"],
+                    pool_data["creatorName"],
+                    pool_data["creatorId"],
+                    pool_data["closureCriteria"],
+                    pool_data["closureInstructions"],
+                )
+            ),
+            label="createPool",
         )
-
-        signed_tx = w3.eth.account.sign_transaction(tx, PRIVATE_KEY)
-        tx_hash = w3.eth.send_raw_transaction(signed_tx.raw_transaction)
-        receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
         print(
-            f"Pool successfully created. Transaction hash: {tx_hash.hex()}, Transaction receipt: {receipt}"
+            f"Pool successfully created. Transaction hash: {receipt['transactionHash'].hex()}, Transaction receipt: {receipt}"
         )
 
         if receipt["logs"]:
@@ -99,6 +140,12 @@ def create_pool(pool_data):
             pool_id = int.from_bytes(data[:32], byteorder="big")
 
             print(f"Pool created with ID: {pool_id}")
+
+            # Have the grading scheduler grade the pool as soon as betting closes
+            try:
+                add_pools(get_redis_client(), {pool_id: pool_data["betsCloseAt"]})
+            except Exception as e:
+                print(f"Error scheduling grading for pool {pool_id}: {str(e)}")
         else:
             print("No logs found in receipt")
 
@@ -228,75 +275,28 @@ def create_pool_data(langgraph_agent_response, creator_name, creator_id):
 
 def set_twitter_post_id(pool_id, tweet_id):
     try:
-        # Build the transaction
-        tx = CONTRACT.functions.setTwitterPostId(pool_id, tweet_id).build_transaction(
-            {
-                "from": ACCOUNT.address,
-                "nonce": w3.eth.get_transaction_count(ACCOUNT.address),
-                "gas": GAS_LIMIT,
-                "gasPrice": w3.eth.gas_price,
-            }
+        receipt = get_tx_manager().transact(
+            get_contract().functions.setTwitterPostId(pool_id, tweet_id),
+            label=f"setTwitterPostId({pool_id})",
         )
 
-        # Sign the transaction
-        signed_tx = w3.eth.account.sign_transaction(tx, PRIVATE_KEY)
-
-        # Send the transaction
-        tx_hash = w3.eth.send_raw_transaction(signed_tx.raw_transaction)
-
-        # Wait for the transaction receipt
-        receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
-
         print(
-            f"Setting twitter transaction successful with hash: {tx_hash.hex()}, receipt: {receipt}"
+            f"Setting twitter transaction successful with hash: {receipt['transactionHash'].hex()}, receipt: {receipt}"
         )
         return receipt
     except Exception as e:
         raise Exception(f"Error setting Twitter post ID: {str(e)}")
 
 
-def fetch_pending_pools():
-    """
-    Fetches pending pools from the GraphQL endpoint and prints their details.
+def fetch_pending_pools(bets_close_before=None, fields=POOL_FIELDS):
     """
-    query = """
-    query {
-      pools(where: {status: "PENDING"}) {
-        id
-        poolIntId
-        status
-        question
-        options
-        betsCloseAt
-        decisionDate
-        closureCriteria
-        closureInstructions
-        totalBets
-        totalBetsByOption
-        xPostId
-      }
-    }
+    Fetches all pending pools from the subgraph, following pagination.
+    Use subgraph.iter_pending_pools to start processing pools before every page has loaded.
     """
-
-    try:
-        # Send the POST request
-        print(f"SUBGRAPH_URL: {SUBGRAPH_URL}")
-        response = requests.post(SUBGRAPH_URL, json={"query": query})
-        response.raise_for_status()
-
-        # Parse the JSON response
-        data = response.json()
-
-        # Return the pools (already filtered by the query)
-        return data["data"]["pools"]
-    except requests.exceptions.RequestException as e:
-        print(f"Request failed: {e}")
-        if response is not None:
-            print(f"Response content: {response.content}")
-        return []
+    return list(iter_pending_pools(bets_close_before=bets_close_before, fields=fields))
 
 
-def grade_pool_with_langgraph_agent(agent, pool):
+async def grade_pool_with_langgraph_agent(agent, pool):
     pool_idea = {}
     pool_idea["betting_pool_idea"] = pool["question"]
     pool_idea["closure_criteria"] = pool["closureCriteria"]
@@ -305,11 +305,14 @@ def grade_pool_with_langgraph_agent(agent, pool):
     pool_idea["options"] = pool["options"]
     pool_idea["current_datetime"] = datetime.now().timestamp()
 
-    idea_grade = agent.invoke(
-        {
-            "betting_pool_idea": pool_idea,
-        }
-    )
+    with span("grader.agent"):
+        idea_grade = await agent.ainvoke(
+            {
+                "pool_id": pool["id"],
+                "betting_pool_idea": pool_idea,
+            },
+            config={"callbacks": get_callbacks("grader", pool_id=pool["id"])},
+        )
 
     result = idea_grade["betting_pool_idea_result"]
 
@@ -338,65 +341,155 @@ def store_pool_grade(pool_id_str, grade):
     redis_client.close()
 
 
-def call_grade_pool_contract(pool_id, grade_result):
+def submit_grade_pool_contract(pool_id, grade_result):
+    """
+    Submit a gradeBet transaction without waiting for it to be mined.
+    Returns a PendingTransaction to pass to wait_for_transactions.
+    """
     print(
-        f"Calling grade pool contract with pool_id: {pool_id} and grade_result: {grade_result}"
+        f"Submitting grade pool contract with pool_id: {pool_id} and grade_result: {grade_result}"
     )
     try:
-        # Build the transaction
-        tx = CONTRACT.functions.gradeBet(pool_id, grade_result).build_transaction(
-            {
-                "from": ACCOUNT.address,
-                "nonce": w3.eth.get_transaction_count(ACCOUNT.address),
-                "gas": GAS_LIMIT,
-                "gasPrice": w3.eth.gas_price,
-            }
+        return get_tx_manager().submit(
+            get_contract().functions.gradeBet(pool_id, grade_result),
+            label=f"gradeBet({pool_id})",
         )
+    except Exception as e:
+        raise Exception(f"Error calling gradeBet contract: {str(e)}")
 
-        # Sign the transaction
-        signed_tx = w3.eth.account.sign_transaction(tx, PRIVATE_KEY)
 
-        # Send the transaction
-        tx_hash = w3.eth.send_raw_transaction(signed_tx.raw_transaction)
+def wait_for_transactions(pending_transactions):
+    """Wait for a batch of submitted transactions. Returns receipts in the same order, None for unconfirmed ones"""
+    return get_tx_manager().wait_for_receipts(pending_transactions)
 
-        # Wait for the transaction receipt
-        receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
+
+def call_grade_pool_contract(pool_id, grade_result):
+    print(
+        f"Calling grade pool contract with pool_id: {pool_id} and grade_result: {grade_result}"
+    )
+    try:
+        receipt = get_tx_manager().transact(
+            get_contract().functions.gradeBet(pool_id, grade_result),
+            label=f"gradeBet({pool_id})",
+        )
 
         print(
-            f"Grading pool transaction successful with hash: {tx_hash.hex()}, receipt: {receipt}"
+            f"Grading pool transaction successful with hash: {receipt['transactionHash'].hex()}, receipt: {receipt}"
         )
         return receipt
     except Exception as e:
         raise Exception(f"Error calling gradeBet contract: {str(e)}")
 
 
-def call_payout_bets_contract(bet_ids):
+def estimate_payout_gas(bet_ids):
+    """
+    Estimate the gas used by claimPayouts as a fixed base cost plus a cost per bet.
+    The per-bet cost is measured from a one-bet and a PAYOUT_GAS_SAMPLE_SIZE-bet call.
+
+    Returns:
+        tuple: (base_gas, gas_per_bet)
+    """
+    sample = bet_ids[:PAYOUT_GAS_SAMPLE_SIZE]
     try:
-        # Build the transaction
-        tx = CONTRACT.functions.claimPayouts(bet_ids).build_transaction(
-            {
-                "from": ACCOUNT.address,
-                "nonce": w3.eth.get_transaction_count(ACCOUNT.address),
-                "gas": GAS_LIMIT,
-                "gasPrice": w3.eth.gas_price,
-            }
-        )
+        with provider_slot("rpc"):
+            single_gas = get_contract().functions.claimPayouts(sample[:1]).estimate_gas(
+                {"from": get_account().address}
+            )
+            if len(sample) < 2:
+                return 0, single_gas
+            sample_gas = get_contract().functions.claimPayouts(sample).estimate_gas(
+                {"from": get_account().address}
+            )
+        gas_per_bet = max((sample_gas - single_gas) // (len(sample) - 1), 1)
+        return max(single_gas - gas_per_bet, 0), gas_per_bet
+    except Exception as e:
+        print(f"Error estimating claimPayouts gas, using fallback of {PAYOUT_GAS_PER_BET_FALLBACK} per bet: {str(e)}")
+        return 0, PAYOUT_GAS_PER_BET_FALLBACK
 
-        # Sign the transaction
-        signed_tx = w3.eth.account.sign_transaction(tx, PRIVATE_KEY)
 
-        # Send the transaction
-        tx_hash = w3.eth.send_raw_transaction(signed_tx.raw_transaction)
+def estimate_chunk_gas(bet_ids):
+    """estimate_gas of a claimPayouts call for exactly these bets, or None if it can't be estimated"""
+    try:
+        with provider_slot("rpc"):
+            return get_contract().functions.claimPayouts(bet_ids).estimate_gas({"from": get_account().address})
+    except Exception as e:
+        print(f"Error estimating claimPayouts gas for {len(bet_ids)} bets: {str(e)}")
+        return None
 
-        # Wait for the transaction receipt
-        receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
 
-        print(
-            f"Grading pool transaction successful with hash: {tx_hash.hex()}, receipt: {receipt}"
-        )
-        return receipt
-    except Exception as e:
-        raise Exception(f"Error calling gradeBet contract: {str(e)}")
+def plan_payout_chunks(bet_ids, gas_budget=PAYOUT_GAS_BUDGET, max_chunk_size=None):
+    """
+    Split bet IDs into the largest chunks whose claimPayouts gas, plus a safety margin, fits the budget.
+    Chunks are sized from the linear estimate, then each is estimated on its own, since winning and losing bets cost
+    different amounts to claim, and split in half while it's over the budget.
+
+    Returns:
+        list: (bet_ids_chunk, gas_limit) tuples
+    """
+    if not bet_ids:
+        return []
+
+    base_gas, gas_per_bet = estimate_payout_gas(bet_ids)
+    chunk_size = max(int((gas_budget / PAYOUT_GAS_MARGIN - base_gas) // gas_per_bet), 1)
+    if max_chunk_size is not None:
+        chunk_size = max(min(chunk_size, max_chunk_size), 1)
+    print(
+        f"claimPayouts gas estimate: {base_gas} base + {gas_per_bet} per bet, {chunk_size} bets per transaction"
+    )
+
+    chunks = []
+    to_check = [bet_ids[i : i + chunk_size] for i in range(0, len(bet_ids), chunk_size)]
+    while to_check:
+        chunk = to_check.pop(0)
+        gas = estimate_chunk_gas(chunk)
+        if gas is None:
+            gas = base_gas + gas_per_bet * len(chunk)
+        elif gas * PAYOUT_GAS_MARGIN > gas_budget and len(chunk) > 1:
+            half = len(chunk) // 2
+            to_check[:0] = [chunk[:half], chunk[half:]]
+            continue
+        chunks.append((chunk, min(int(gas * PAYOUT_GAS_MARGIN), gas_budget)))
+    return chunks
+
+
+def call_payout_bets_contract(bet_ids, max_chunk_size=None):
+    """
+    Pay out bets in as many claimPayouts transactions as needed to stay under PAYOUT_GAS_BUDGET,
+    with at most `max_chunk_size` bets each if given. All chunks are submitted back-to-back and confirmed together.
+
+    Returns:
+        dict: {"confirmed": [bet_ids_chunk, ...], "failed": [bet_ids_chunk, ...]}
+    """
+    report = {"confirmed": [], "failed": []}
+    submitted = []
+    for chunk, gas_limit in plan_payout_chunks(bet_ids, max_chunk_size=max_chunk_size):
+        try:
+            submitted.append(
+                (
+                    chunk,
+                    get_tx_manager().submit(
+                        get_contract().functions.claimPayouts(chunk),
+                        gas=gas_limit,
+                        label=f"claimPayouts({len(chunk)} bets)",
+                    ),
+                )
+            )
+        except Exception as e:
+            print(f"Error calling claimPayouts contract for {len(chunk)} bets: {str(e)}")
+            report["failed"].append(chunk)
+
+    receipts = get_tx_manager().wait_for_receipts([pending for _, pending in submitted])
+    for (chunk, pending), receipt in zip(submitted, receipts):
+        if receipt is not None and receipt["status"] == 1:
+            print(
+                f"Payout transaction successful for {len(chunk)} bets with hash: {pending.tx_hash.hex()}"
+            )
+            report["confirmed"].append(chunk)
+        else:
+            print(f"Payout transaction failed for {len(chunk)} bets with hash: {pending.tx_hash.hex()}, receipt: {receipt}")
+            report["failed"].append(chunk)
+
+    return report
 
 
 def fetch_bets_for_pool(pool_id):
@@ -2,28 +2,67 @@ from datetime import datetime, timedelta
 from pprint import pprint
 from typing import Annotated
 from pydantic import BaseModel
+import asyncio
 import json
+import operator
+import os
+import time
 
 from dotenv import load_dotenv
-from langchain_anthropic import ChatAnthropic
-from langchain_core.messages import SystemMessage
+from langchain_core.messages import HumanMessage, SystemMessage
 from langgraph.graph import END, START, MessagesState, StateGraph
-from common import big_llm, smol_llm
+from common import get_big_llm, get_cached_smol_llm, get_smol_llm, lazy
 from db.betting_pool_db import BettingPoolDB
-from langchain_community.tools.tavily_search import TavilySearchResults
+from provider_limits import async_provider_slot
 import random
 
 from tools.news import get_news_for_topic
+from tools.context_builder import build_context
+from tools.search_cache import cached_tavily_search
 
 load_dotenv()
 
-tavily_search = TavilySearchResults(
-    max_results=2,
-    include_answer=True,
-    include_raw_content=True,
-    include_images=False,
-    # search_depth="advanced", # Unclear what this does
-)
+# Seconds the news and web search branches have, together, once the topic is known.
+# Whichever branch hasn't finished by then is dropped and the idea is generated from what arrived.
+RESEARCH_TIMEOUT = float(os.getenv("RESEARCH_TIMEOUT", 15))
+
+# Fast mode (prefer_fast_response) settings. FAST_RESPONSE_BUDGET is the end-to-end target in seconds,
+# of which FAST_GENERATION_RESERVE is kept for generating the idea; research gets whatever is left before that.
+FAST_RESPONSE_BUDGET = float(os.getenv("FAST_RESPONSE_BUDGET", 20))
+FAST_GENERATION_RESERVE = float(os.getenv("FAST_GENERATION_RESERVE", 8))
+# Seconds given to the small-model fallback when idea generation runs out of budget, so there is still an answer
+FAST_FALLBACK_TIMEOUT = float(os.getenv("FAST_FALLBACK_TIMEOUT", 5))
+FAST_SEARCH_MAX_RESULTS = int(os.getenv("FAST_SEARCH_MAX_RESULTS", 2))
+# Token budgets for the search context in the idea generation prompt, in full and fast mode
+SEARCH_CONTEXT_TOKENS = int(os.getenv("SEARCH_CONTEXT_TOKENS", 3000))
+FAST_CONTEXT_TOKENS = int(os.getenv("FAST_CONTEXT_TOKENS", 800))
+
+@lazy
+def get_tavily_search():
+    from langchain_community.tools.tavily_search import TavilySearchResults
+
+    return TavilySearchResults(
+        max_results=2,
+        include_answer=True,
+        include_raw_content=True,
+        include_images=False,
+        # search_depth="advanced", # Unclear what this does
+    )
+
+
+@lazy
+def get_fast_tavily_search():
+    """Basic-depth search returning snippets only, for fast mode"""
+    from langchain_community.tools.tavily_search import TavilySearchResults
+
+    return TavilySearchResults(
+        max_results=FAST_SEARCH_MAX_RESULTS,
+        search_depth="basic",
+        include_answer=True,
+        include_raw_content=False,
+        include_images=False,
+    )
+
 
 class BettingPoolGeneratorOutput(BaseModel):
     betting_pool_idea: str
@@ -42,6 +81,14 @@ class ResearchGraphOutput(MessagesState):
     news_results: list[str]
     # image_results: list[dict]
     search_results: list
+    # Unix time by which the research branches must have returned
+    research_deadline: float
+    prefer_fast_response: bool
+    started_at: float
+    # Steps that ran out of time and were skipped or downgraded
+    degraded_steps: Annotated[list[str], operator.add]
+    # Which path was taken ("fast" or "full"), what was degraded, and how long it took
+    generation_report: dict
     betting_pool_idea: BettingPoolGeneratorOutput
 
 
@@ -53,8 +100,9 @@ class ImageSearchQuery(BaseModel):
     search_query: str
 
 
-def extract_topic(state: ResearchGraphOutput):
+async def extract_topic(state: ResearchGraphOutput):
     """Extract the topic from the state"""
+    started_at = time.time()
     prompt = f"""
     The user has asked you to generate a betting pool with this message:
     <message>{state.get("message")}</message>
@@ -81,22 +129,46 @@ def extract_topic(state: ResearchGraphOutput):
     }}
     """
 
-    structured_llm = smol_llm.with_structured_output(BettingPoolGeneratorTopicOutput)
-    topic = structured_llm.invoke([prompt] + state["messages"])
+    # The topic only depends on the message, so repeated messages are answered from the LLM cache
+    structured_llm = get_cached_smol_llm().with_structured_output(BettingPoolGeneratorTopicOutput)
+    # In fast mode, extraction may use at most the research share of the budget
+    timeout = FAST_RESPONSE_BUDGET - FAST_GENERATION_RESERVE if state.get("prefer_fast_response") else None
+    try:
+        topic = await asyncio.wait_for(_ainvoke_llm(structured_llm, [prompt] + state["messages"]), timeout)
+    except asyncio.TimeoutError:
+        # Use the user's own words as the topic rather than spend more of the budget
+        print("Timed out extracting topic, using the message as the topic")
+        return {
+            "topic": _last_message_text(state),
+            "started_at": started_at,
+            "degraded_steps": ["extract_topic"],
+        }
     print("extracted topic:", topic)
 
-    return {"topic": topic.topic}
+    return {"topic": topic.topic, "started_at": started_at}
+
+
+async def _ainvoke_llm(llm, messages):
+    # Waiting for an llm slot counts against the caller's timeout too
+    async with async_provider_slot("llm"):
+        return await llm.ainvoke(messages)
+
+
+def _last_message_text(state: ResearchGraphOutput):
+    messages = state.get("messages") or []
+    return str(messages[-1].content).strip() if messages else ""
 
 
 # If the user doesn't provide a topic, generate one
-def generate_topic(state: ResearchGraphOutput):
+async def generate_topic(state: ResearchGraphOutput):
     """Generate a topic for the betting pool if user doesn't provide one"""
 
     if state.get("topic"):
-        return {"topic": state.get("topic")}
+        return {"topic": state.get("topic"), "research_deadline": research_deadline(state)}
 
-    betting_pool_db = BettingPoolDB()
-    recent_pools = betting_pool_db.get_recent_pools()
+    # sqlite, so kept off the event loop
+    betting_pool_db = await asyncio.to_thread(BettingPoolDB)
+    recent_pools = await asyncio.to_thread(betting_pool_db.get_recent_pools)
 
     recent_examples = "\n".join(
         [
@@ -132,15 +204,46 @@ def generate_topic(state: ResearchGraphOutput):
     """
     )
 
-    structured_llm = smol_llm.with_structured_output(BettingPoolGeneratorTopicOutput)
-    topic = structured_llm.invoke([topic_sys_msg] + state["messages"])
+    structured_llm = get_smol_llm().with_structured_output(BettingPoolGeneratorTopicOutput)
+    timeout = fast_time_left(state, FAST_GENERATION_RESERVE) if state.get("prefer_fast_response") else None
+    try:
+        topic = await asyncio.wait_for(_ainvoke_llm(structured_llm, [topic_sys_msg] + state["messages"]), timeout)
+    except asyncio.TimeoutError:
+        print("Timed out generating a topic, leaving it to idea generation")
+        return {"topic": "", "research_deadline": research_deadline(state), "degraded_steps": ["generate_topic"]}
     print("generated topic:", topic)
-    return {"topic": topic.topic}
+    return {"topic": topic.topic, "research_deadline": research_deadline(state)}
+
 
-def get_news_results(state: ResearchGraphOutput):
+def fast_time_left(state: ResearchGraphOutput, reserve=0):
+    """Seconds left of FAST_RESPONSE_BUDGET, keeping `reserve` seconds back"""
+    return max(state.get("started_at", time.time()) + FAST_RESPONSE_BUDGET - reserve - time.time(), 0)
+
+
+def research_deadline(state: ResearchGraphOutput):
+    """
+    In fast mode, research must finish early enough to leave FAST_GENERATION_RESERVE of the budget for generation.
+    Otherwise it gets RESEARCH_TIMEOUT from now.
+    """
+    if state.get("prefer_fast_response"):
+        return state.get("started_at", time.time()) + FAST_RESPONSE_BUDGET - FAST_GENERATION_RESERVE
+    return time.time() + RESEARCH_TIMEOUT
+
+
+def research_time_left(state: ResearchGraphOutput):
+    """Seconds left before the research deadline set by generate_topic"""
+    return max(state.get("research_deadline", time.time() + RESEARCH_TIMEOUT) - time.time(), 0)
+
+async def get_news_results(state: ResearchGraphOutput):
     # For fast responses, fetch news articles first
     news_results = ""
-    news_articles = get_news_for_topic(state.get("topic"))
+    try:
+        news_articles = await asyncio.wait_for(
+            get_news_for_topic(state.get("topic")), timeout=research_time_left(state)
+        )
+    except asyncio.TimeoutError:
+        print(f"Timed out fetching news for topic: {state.get('topic')}")
+        return {"news_results": news_results, "degraded_steps": ["get_news_results"]}
     if news_articles:
         news_results = (
             "\n\nHere are some recent news articles about this topic:\n"
@@ -152,44 +255,43 @@ def get_news_results(state: ResearchGraphOutput):
 
     return {"news_results": news_results}
 
-def search_for_topic(state: ResearchGraphOutput):
+async def search_for_topic(state: ResearchGraphOutput):
     """Search for information about the topic using Tavily search"""
     topic = state.get("topic")
+    fast = state.get("prefer_fast_response", False)
     print(f"Searching for information about: {topic}")
     
     try:
         # Perform the search using Tavily
-        search_results = tavily_search.invoke(topic)
+        search = get_fast_tavily_search() if fast else get_tavily_search()
+        search_results = await asyncio.wait_for(
+            cached_tavily_search(search, topic), timeout=research_time_left(state)
+        )
         
-        # Process the search results
-        processed_results = []
-
+        # Collect the pages, preferring their full text where the search returned it
+        documents = []
         print(f"Search results: {search_results}")
-        
-        if isinstance(search_results, list):
-            # Handle list format
-            for result in search_results:
-                if isinstance(result, dict):
-                    # Extract title and content if available
-                    title = result.get("title", "No title")
-                    content = result.get("content", result.get("raw_content", "No content"))
-                    url = result.get("url", "No URL")
-                    
-                    # Format the result
-                    formatted_result = f"Title: {title}\nURL: {url}\nContent: {content}\n"
-                    processed_results.append(formatted_result)
-        elif isinstance(search_results, dict):
-            # Handle dictionary format
-            for result in search_results.get("results", []):
-                if isinstance(result, dict):
-                    # Extract title and content if available
-                    title = result.get("title", "No title")
-                    content = result.get("content", result.get("raw_content", "No content"))
-                    url = result.get("url", "No URL")
-                    
-                    # Format the result
-                    formatted_result = f"Title: {title}\nURL: {url}\nContent: {content}\n"
-                    processed_results.append(formatted_result)
+        results = search_results if isinstance(search_results, list) else []
+        if isinstance(search_results, dict):
+            results = search_results.get("results", [])
+        for result in results:
+            if isinstance(result, dict):
+                documents.append(
+                    {
+                        "title": result.get("title", "No title"),
+                        "url": result.get("url", "No URL"),
+                        "content": result.get("raw_content") or result.get("content") or "No content",
+                    }
+                )
+
+        # Keep only the passages most relevant to the topic, within the prompt's token budget
+        processed_results = []
+        context, report = build_context(
+            topic, documents, FAST_CONTEXT_TOKENS if fast else SEARCH_CONTEXT_TOKENS
+        )
+        print(f"Search context for topic '{topic}': {report}")
+        if context:
+            processed_results.append(context)
         
         # If we have an answer from Tavily, add it as well
         if isinstance(search_results, dict) and "answer" in search_results:
@@ -199,46 +301,37 @@ def search_for_topic(state: ResearchGraphOutput):
         
         # Join all processed results
         if processed_results:
-            print(f"Found {len(processed_results)} search results for topic: {topic}")
+            print(f"Found {len(documents)} search results for topic: {topic}")
             return {"search_results": processed_results}
         else:
             print(f"No search results found for topic: {topic}")
             return {"search_results": ["No relevant information found for this topic."]}
             
+    except asyncio.TimeoutError:
+        print(f"Timed out searching for topic: {topic}")
+        return {
+            "search_results": ["No relevant information found for this topic."],
+            "degraded_steps": ["search_for_topic"],
+        }
     except Exception as e:
         print(f"Error searching for topic: {e}")
         return {"search_results": [f"Error searching for information: {str(e)}"]}
 
-def generate_betting_pool_idea(state: ResearchGraphOutput):
-    """Generate a betting pool"""
-    print("Generating betting pool idea")
-    betting_pool_db = BettingPoolDB()
-    
-    # Get current date for reference
-    current_date = datetime.now()
-    tomorrow = current_date + timedelta(days=1)
-    tomorrow_str = tomorrow.strftime("%Y-%m-%dT23:59:59Z")
 
-    # For fast responses, fetch news articles first
-    news_context = state.get("news_results")
-    search_context = state.get("search_results")
-    prompt = f"""
-  
+# Instructions for generate_betting_pool_idea. They are the same on every call and are sent first, so the provider can
+# serve them from its prompt prefix cache; the topic, context and current date follow in a separate message.
+BETTING_POOL_IDEA_INSTRUCTIONS = """
     Your goal is to generate an idea for something that users would like to bet on.
-    
-    Here is the high-level topic: 
-    <topic>{state.get("topic")}</topic>
-    <news_context>{news_context}</news_context>
-    <search_context>{search_context}</search_context>
-    
-    {f'Original user message: <message>{state.get("message")}</message>' if state.get("message") else ''}
-    
+
+    You will be given a high-level topic, news and search context about it, sometimes the original user message,
+    and the current date and time.
+
     ## Generation guidelines
     - You can feel free to remix the topic, but try to keep the same theme.
     - If the user provided a specific message, prioritize and focus on creating a betting pool that directly addresses their query. Use the news context as reference, but don't feel constrained by it in this case.
     - Your response must be for a pool that can only be resolved in the future. Do not create a pool based on past events.
     - Avoid ambiguity in the betting pool idea. For instance, don't suggest "will a major stock reach 200% in...", instead provide a specific stock to see if it will reach a certain price.
-    - Do not generate ideas for known outcomes or for things in the past. Note that the current date and time is {current_date.strftime("%Y-%m-%d %H:%M:%S")}.
+    - Do not generate ideas for known outcomes or for things in the past. The current date and time are given after the topic.
     - For time-sensitive bets (like weather predictions), use dates that are very close to the current date.
     - You must provide exactly 2 mutually exclusive options. Examples:
       * "Above $500" vs "Below or equal to $500"
@@ -287,7 +380,7 @@ def generate_betting_pool_idea(state: ResearchGraphOutput):
     - If you're uncertain about a specific fact, make the betting pool more general rather than risking a factual error
     
      Your response must be the following JSON object and nothing else, no markdown, no comments, just the JSON object:
-     {{
+     {
         "betting_pool_idea": "", // Single sentence describing what users are betting on - should include the specific date when applicable
         "options": ["", ""], // List of exactly 2 options for the betting pool
         "closure_summary": "", // Single sentence summary of what date, condition, event, criteria, etc. that will determine a winner for this bet
@@ -297,17 +390,67 @@ def generate_betting_pool_idea(state: ResearchGraphOutput):
         "odds_format": "", // "decimal", "fractional", "american", idk what this is
         "odds_type": "", // "positive", "negative", idk what this is
         "odds_value": "" // The actual odds value, idk what this is
-     }}
+     }
    
    Response must be a valid JSON object with no additional formatting, no markdown, and no code fences.
+    """
 
-   Remember that you must never generate a betting pool idea for a past event. Today's date and time is {current_date.strftime("%Y-%m-%d %H:%M:%S")}. Only generate ideas for future events past this date and time.
+
+async def generate_betting_pool_idea(state: ResearchGraphOutput):
+    """Generate a betting pool"""
+    print("Generating betting pool idea")
+    betting_pool_db = await asyncio.to_thread(BettingPoolDB)
+    
+    # Get current date for reference
+    current_date = datetime.now()
+    tomorrow = current_date + timedelta(days=1)
+    tomorrow_str = tomorrow.strftime("%Y-%m-%dT23:59:59Z")
+
+    def idea_prompt(with_context):
+        context = f"""
+    <news_context>{state.get("news_results")}</news_context>
+    <search_context>{state.get("search_results")}</search_context>
+    """ if with_context else ""
+        return f"""
+    Here is the high-level topic: 
+    <topic>{state.get("topic")}</topic>
+    {context}
+    {f'Original user message: <message>{state.get("message")}</message>' if state.get("message") else ''}
+
+    Remember that you must never generate a betting pool idea for a past event. Today's date and time is {current_date.strftime("%Y-%m-%d %H:%M:%S")}. Only generate ideas for future events past this date and time.
     """
 
+    async def generate(llm, prompt, timeout):
+        return await asyncio.wait_for(
+            _ainvoke_llm(
+                llm,
+                [SystemMessage(content=BETTING_POOL_IDEA_INSTRUCTIONS), HumanMessage(content=prompt)] + state["messages"],
+            ),
+            timeout,
+        )
+
+    # In fast mode generation gets whatever is left of the budget. The small model is used from the start if research
+    # ate into the time reserved for generation, and without the research context if the big model runs out of time
+    fast = state.get("prefer_fast_response", False)
+    started_at = state.get("started_at", time.time())
+    degraded_steps = []
+    llm = get_big_llm()
+    timeout = fast_time_left(state) if fast else None
+    if fast and timeout < FAST_GENERATION_RESERVE:
+        degraded_steps.append("generate_betting_pool_idea")
+        llm = get_smol_llm()
+
     # Use the existing BettingPoolGeneratorOutput Pydantic model
     # structured_llm = selected_llm.with_structured_output(BettingPoolGeneratorOutput)
     # betting_pool_idea = structured_llm.invoke([prompt] + state["messages"])
-    betting_pool_idea = big_llm.invoke([prompt] + state["messages"])
+    try:
+        betting_pool_idea = await generate(llm, idea_prompt(with_context=True), timeout)
+    except asyncio.TimeoutError:
+        print("Timed out generating betting pool idea, retrying with the small model and no research context")
+        degraded_steps.append("generate_betting_pool_idea_context")
+        betting_pool_idea = await generate(
+            get_smol_llm(), idea_prompt(with_context=False), max(fast_time_left(state), FAST_FALLBACK_TIMEOUT)
+        )
     print("Betting pool idea:", betting_pool_idea)
     betting_pool_idea = json.loads(
         betting_pool_idea.content.replace("```json", "").replace(
@@ -317,27 +460,51 @@ def generate_betting_pool_idea(state: ResearchGraphOutput):
 
     # Store the new betting pool idea in the database to avoid repeating the same idea multiple time when invoked
     try:
-        betting_pool_db.add_betting_pool(state.get("topic"), betting_pool_idea)
+        await asyncio.to_thread(betting_pool_db.add_betting_pool, state.get("topic"), betting_pool_idea)
     except Exception as e:
         print(f"Error storing betting pool: {e}")
 
-    return {"betting_pool_idea": betting_pool_idea}
+    generation_report = {
+        "path": "fast" if fast else "full",
+        "degraded_steps": state.get("degraded_steps", []) + degraded_steps,
+        "seconds": round(time.time() - started_at, 3),
+    }
+    print("Generation report:", generation_report)
+
+    return {
+        "betting_pool_idea": betting_pool_idea,
+        "degraded_steps": degraded_steps,
+        "generation_report": generation_report,
+    }
+
+
+@lazy
+def get_betting_pool_idea_generator_agent():
+    """Build and compile the generator graph on first use"""
+    betting_pool_idea_generator = StateGraph(ResearchGraphOutput)
+    betting_pool_idea_generator.add_node("extract_topic", extract_topic)
+    betting_pool_idea_generator.add_node("generate_topic", generate_topic)
+    betting_pool_idea_generator.add_node("search_for_topic", search_for_topic)
+    betting_pool_idea_generator.add_node("get_news_results", get_news_results)
+    betting_pool_idea_generator.add_node(
+        "generate_betting_pool_idea", generate_betting_pool_idea
+    )
 
+    betting_pool_idea_generator.add_edge(START, "extract_topic")
+    betting_pool_idea_generator.add_edge("extract_topic", "generate_topic")
+    # News and web search don't depend on each other, so they run in parallel and join before generation
+    betting_pool_idea_generator.add_edge("generate_topic", "get_news_results")
+    betting_pool_idea_generator.add_edge("generate_topic", "search_for_topic")
+    betting_pool_idea_generator.add_edge(
+        ["get_news_results", "search_for_topic"], "generate_betting_pool_idea"
+    )
+    betting_pool_idea_generator.add_edge("generate_betting_pool_idea", END)
 
-betting_pool_idea_generator = StateGraph(ResearchGraphOutput)
-betting_pool_idea_generator.add_node("extract_topic", extract_topic)
-betting_pool_idea_generator.add_node("generate_topic", generate_topic)
-betting_pool_idea_generator.add_node("search_for_topic", search_for_topic)
-betting_pool_idea_generator.add_node("get_news_results", get_news_results)
-betting_pool_idea_generator.add_node(
-    "generate_betting_pool_idea", generate_betting_pool_idea
-)
+    return betting_pool_idea_generator.compile()
 
-betting_pool_idea_generator.add_edge(START, "extract_topic")
-betting_pool_idea_generator.add_edge("extract_topic", "generate_topic")
-betting_pool_idea_generator.add_edge("generate_topic", "get_news_results")
-betting_pool_idea_generator.add_edge("get_news_results", "search_for_topic")
-betting_pool_idea_generator.add_edge("search_for_topic", "generate_betting_pool_idea")
-betting_pool_idea_generator.add_edge("generate_betting_pool_idea", END)
 
-betting_pool_idea_generator_agent = betting_pool_idea_generator.compile()
+def __getattr__(name):
+    # `betting_pool_idea_generator_agent` is compiled on first access (it is also what langgraph.json points at)
+    if name == "betting_pool_idea_generator_agent":
+        return get_betting_pool_idea_generator_agent()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,13 +1,20 @@
 from betting_pool_core import (
     call_payout_bets_contract,
-    fetch_bets_for_pool,
-    fetch_pending_pools,
     grade_pool_with_langgraph_agent,
     post_close_market_tweets,
     store_pool_grade,
-    call_grade_pool_contract,
+    submit_grade_pool_contract,
+    wait_for_transactions,
 )
-from betting_idea_grader import betting_pool_idea_grader_agent
+from betting_idea_grader import get_betting_pool_idea_grader_agent
+from db.redis import get_redis_client
+from grading_schedule import claim_pool, clear_schedule, due_pool_ids, release_pools, schedule_next_check
+from grading_triage import triage_pool
+from instrumentation import prompt_cache_handler
+from subgraph import fetch_unclaimed_bets_for_pools, iter_pending_pools
+from tools.search_cache import search_cache_stats
+from tracing import start_trace
+import asyncio
 import logging
 import time
 from datetime import datetime
@@ -17,6 +24,21 @@ import os
 # Load environment variables
 load_dotenv()
 FRONTEND_URL_PREFIX = os.getenv("FRONTEND_URL_PREFIX")
+# Number of pools graded at the same time. Per-provider limits are configured in provider_limits.py
+GRADING_CONCURRENCY = int(os.getenv("GRADING_CONCURRENCY", 8))
+PAYOUT_RETRIES = int(os.getenv("PAYOUT_RETRIES", 1))
+# Pool fields needed to grade a pool and tweet its result
+GRADING_POOL_FIELDS = (
+    "id",
+    "question",
+    "options",
+    "betsCloseAt",
+    "decisionDate",
+    "closureCriteria",
+    "closureInstructions",
+    "totalBets",
+    "xPostId",
+)
 
 # Configure logging
 logging.basicConfig(
@@ -26,125 +48,259 @@ logging.basicConfig(
 )
 
 
-def grade_pending_pools():
+async def grade_pool(pool):
+    """
+    Grade a single pool, retrying the grader up to 3 times.
+    Returns the grade result if the pool was resolved, otherwise None.
+    """
+    pool_id = pool["id"]
+    retry_count = 0
+    last_error = None
+    unresolved_result = None
+    while retry_count <= 2:
+        try:
+            logging.info(f"Processing pool {pool_id}")
+
+            # Grade the pool
+            grade_result = await grade_pool_with_langgraph_agent(
+                get_betting_pool_idea_grader_agent(), pool
+            )
+            logging.info(f"Pool {pool_id} graded with result: {grade_result}")
+
+            # Set pool data to grade_result for processing
+            grade_result["pool_data"] = pool
+
+            # for testing
+            # grade_result['result_code'] = 1
+
+            if grade_result["result_code"] == 4:  # 4 = "error"
+                # TODO: Print the reason here
+                last_error = grade_result.get("explanation")
+                logging.error(f"Error grading pool {pool_id}. Trying again...")
+                retry_count += 1
+                continue
+
+            if grade_result["result_code"] != 0:  # 0 = "not yet resolved"
+                return grade_result
+            unresolved_result = grade_result
+            break
+
+        except Exception as e:
+            last_error = str(e)
+            logging.error(f"Error processing pool {pool_id}: {last_error}. Trying again...")
+            retry_count += 1
+
+    # Scheduled outside the retries, so a Redis error doesn't cause the pool to be graded again
+    if unresolved_result is None:
+        logging.error(f"Error processing pool {pool_id}: {last_error}. Giving up.")
+    try:
+        next_check_at = await asyncio.to_thread(
+            schedule_next_check,
+            get_redis_client(),
+            pool_id,
+            unresolved_result.get("next_check_at") if unresolved_result else None,
+        )
+        if unresolved_result:
+            logging.info(f"Pool {pool_id} is not yet resolved, next check at {datetime.fromtimestamp(next_check_at)}")
+    except Exception as e:
+        logging.error(f"Error scheduling next check for pool {pool_id}: {str(e)}")
+    return None
+
+
+def grade_pending_pools(concurrency=GRADING_CONCURRENCY):
     """
     Cron job to grade pending pools:
-    1. Fetch all pending pools
-    2. Grade each pool
-    3. Store the grades in Redis
+    1. Stream pending pools whose betting has closed
+    2. Grade each closed pool whose next check is due (see grading_schedule.py) and that triage says could resolve
+       now (see grading_triage.py), up to `concurrency` pools at a time
+    3. Submit a gradeBet transaction for each resolved pool as soon as it is graded
+    4. Wait for all gradeBet transactions to confirm
     """
     try:
-        # Fetch pending pools
+        # Stream closed pending pools from the subgraph, grading each page while the next one loads
         logging.info("Fetching pending pools...")
-        pending_pools = fetch_pending_pools()
-        logging.info(f"Found {len(pending_pools)} pending pools")
+        closed_pools = iter_pending_pools(
+            bets_close_before=time.time(), fields=GRADING_POOL_FIELDS
+        )
 
         # for testing
-        # print(f"All pending_pools:")
-        # for pool in pending_pools:
-        #     print(f"pool: {pool}")
+        # closed_pools = [pool for pool in closed_pools if pool['id'] == '7']
 
-        # pending_pools = [pending_pools[0]]
-        # pending_pools = [pool for pool in pending_pools if pool['id'] == '7']
+        return asyncio.run(grade_pools(closed_pools, concurrency))
+    except Exception as e:
+        logging.error(f"Error in grade_pending_pools: {str(e)}")
 
-        logging.info(f"pending_pools: {pending_pools}")
 
-        graded_pools = {}
-        # Process each pool
-        for pool in pending_pools:
-            pool_close_at = int(pool["betsCloseAt"])
+async def grade_pools(pools, concurrency=GRADING_CONCURRENCY, check_schedule=True):
+    """
+    Grade pools from the `pools` iterator and submit gradeBet for the resolved ones.
+    With check_schedule, pools whose next check isn't due are skipped. Pools leased by another process are skipped.
+    Returns {pool_id: grade_result} for the pools whose gradeBet transaction confirmed. If the iterator fails, the
+    pools it yielded are still graded and submitted before its error is raised.
+    """
+    closed_pools = iter(pools)
 
-            logging.info(f"pool_close_at: {pool_close_at}, time.time(): {time.time()}")
-            if pool_close_at <= time.time():
-                retry_count = 0
-                pool_id = pool["id"]
-                while True:
-                    try:
+    # The graders share one event loop, so the semaphore bounds how many pools are in flight
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
 
-                        logging.info(f"Processing pool {pool_id}")
+    redis_client = get_redis_client()
+    triaged_out = []
 
-                        # Grade the pool
-                        grade_result = grade_pool_with_langgraph_agent(
-                            betting_pool_idea_grader_agent, pool
-                        )
-                        logging.info(
-                            f"Pool {pool_id} graded with result: {grade_result}"
+    async def grade(pool):
+        async with semaphore:
+            with start_trace("grade_pool", pool_id=pool["id"]) as trace:
+                should_grade, reason = await triage_pool(pool)
+                trace.set(triaged_out=not should_grade)
+                if not should_grade:
+                    # Nothing to grade before the decision date, so check again then
+                    logging.info(f"Skipping pool {pool['id']}: {reason}")
+                    triaged_out.append(pool["id"])
+                    try:
+                        await asyncio.to_thread(
+                            schedule_next_check, redis_client, pool["id"], int(pool["decisionDate"]), count_attempt=False
                         )
-
-                        # Set pool data to grade_result for processing
-                        grade_result["pool_data"] = pool
-
-                        # for testing
-                        # grade_result['result_code'] = 1
-
-                        # Store the grade in Redis
-                        if grade_result["result_code"] != 4:  # 4 = "error"
-                            if (
-                                grade_result["result_code"] == 0
-                            ):  # 0 = "not yet resolved"
-                                logging.info(f"Pool {pool_id} is not yet resolved")
-                            else:
-                                # call the contract to update the pool
-                                print(f"Pool {pool_id} is resolved, updating pool {pool_id} with result {grade_result['result_code']}")
-                                call_grade_pool_contract(
-                                    # pool_id is "#" (Ex: "3"). Although technically a bigint in contract, we're not realistically going to hit the cap of int32, so cast to int here.
-                                    int(pool_id), grade_result["result_code"]
-                                )
-                                graded_pools[pool_id] = grade_result
-                            break
-                        else:
-                            # TODO: Print the reason here
-                            logging.error(
-                                f"Error grading pool {pool_id}. Trying again..."
-                            )
-                            retry_count += 1
-
                     except Exception as e:
-                        logging.error(
-                            f"Error processing pool {pool_id}: {str(e)}. Trying again..."
-                        )
-                        retry_count += 1
-                    finally:
-                        if retry_count > 2:
-                            logging.error(
-                                f"Error processing pool {pool_id}: {str(e)}. Giving up."
-                            )
-                            break
+                        logging.error(f"Error scheduling next check for pool {pool['id']}: {str(e)}")
+                    return pool["id"], None
+                return pool["id"], await grade_pool(pool)
 
+    tasks = []
+    claimed = []
+    skipped = 0
+    stream_error = None
+    try:
+        while True:
+            try:
+                pool = await asyncio.to_thread(next, closed_pools, None)
+            except Exception as e:
+                # Finish the pools already queued, then surface the failure instead of treating it as the last page
+                stream_error = e
+                break
+            if pool is None:
+                break
+            try:
+                due = not check_schedule or await asyncio.to_thread(due_pool_ids, redis_client, [pool["id"]])
+                if due and not await asyncio.to_thread(claim_pool, redis_client, pool["id"]):
+                    logging.info(f"Pool {pool['id']} is being graded by another process")
+                    due = False
+                elif due:
+                    claimed.append(pool["id"])
+            except Exception as e:
+                # Grade anyway rather than skip pools when the schedule can't be read
+                logging.error(f"Error reading grading schedule for pool {pool['id']}: {str(e)}")
+                due = True
+            if not due:
+                skipped += 1
+                continue
+            logging.info(f"Queueing pool {pool['id']} for grading")
+            tasks.append(asyncio.create_task(grade(pool)))
+        logging.info(
+            f"Grading {len(tasks)} closed pools with concurrency {concurrency}, {skipped} not due or already leased"
+        )
+
+        graded_pools = await _submit_grades(tasks, redis_client, triaged_out)
+        if stream_error is not None:
+            raise stream_error
         return graded_pools
+    finally:
+        try:
+            await asyncio.to_thread(release_pools, redis_client, claimed)
+        except Exception as e:
+            logging.error(f"Error releasing grading leases: {str(e)}")
+
 
+async def _submit_grades(tasks, redis_client, triaged_out):
+    """Submit gradeBet for each pool as its grading task resolves it, then wait for the transactions to confirm"""
+    resolved_pools = {}
+    pending_transactions = {}
+    for task in asyncio.as_completed(tasks):
+        pool_id, grade_result = await task
+        if grade_result is None:
+            continue
+        try:
+            # call the contract to update the pool, without waiting for the previous gradeBet to be mined
+            print(f"Pool {pool_id} is resolved, updating pool {pool_id} with result {grade_result['result_code']}")
+            pending_transactions[pool_id] = await asyncio.to_thread(
+                submit_grade_pool_contract,
+                # pool_id is "#" (Ex: "3"). Although technically a bigint in contract, we're not realistically going to hit the cap of int32, so cast to int here.
+                int(pool_id),
+                grade_result["result_code"],
+            )
+            resolved_pools[pool_id] = grade_result
+        except Exception as e:
+            logging.error(f"Error processing pool {pool_id}: {str(e)}")
+
+    logging.info(f"Triage skipped {len(triaged_out)} pools, avoiding {len(triaged_out)} grader runs: {triaged_out}")
+
+    graded_pools = {}
+    pool_ids = list(pending_transactions.keys())
+    receipts = await asyncio.to_thread(
+        wait_for_transactions, [pending_transactions[pool_id] for pool_id in pool_ids]
+    )
+    for pool_id, receipt in zip(pool_ids, receipts):
+        if receipt is not None and receipt["status"] == 1:
+            graded_pools[pool_id] = resolved_pools[pool_id]
+        else:
+            logging.error(f"gradeBet transaction for pool {pool_id} did not succeed: {receipt}")
+    try:
+        await asyncio.to_thread(clear_schedule, redis_client, list(graded_pools))
     except Exception as e:
-        logging.error(f"Error in grade_pending_pools: {str(e)}")
+        logging.error(f"Error clearing grading schedule: {str(e)}")
+
+    logging.info(f"Search cache stats: {search_cache_stats()}")
+    logging.info(f"Prompt cache stats: {prompt_cache_handler.stats()}")
+    return graded_pools
 
 
 def pay_out_bets(graded_pools):
     """
-    Pay out bets for each pool
+    Pay out bets for each pool.
+    Chunks that fail are retried up to PAYOUT_RETRIES times, re-planning only the bets in those chunks
+    into chunks at most half the size of the largest failed one, in case they ran out of gas.
     """
-    bets_to_pay_out = []
-    for pool_id in graded_pools:
-        bets = fetch_bets_for_pool(int(pool_id))
-        for bet in bets:
-            bets_to_pay_out.append(int(bet["betIntId"]))
+    bets_by_pool = fetch_unclaimed_bets_for_pools(graded_pools)
+    bets_to_pay_out = [
+        bet_id for bet_ids in bets_by_pool.values() for bet_id in bet_ids
+    ]
 
     print(f"bets_to_pay_out: {bets_to_pay_out}")
-    if bets_to_pay_out:
-        call_payout_bets_contract(bets_to_pay_out)
+    max_chunk_size = None
+    for attempt in range(PAYOUT_RETRIES + 1):
+        if not bets_to_pay_out:
+            break
+        report = call_payout_bets_contract(bets_to_pay_out, max_chunk_size=max_chunk_size)
+        logging.info(
+            f"Paid out {sum(len(chunk) for chunk in report['confirmed'])} bets in {len(report['confirmed'])} transactions"
+        )
+        bets_to_pay_out = [bet_id for chunk in report["failed"] for bet_id in chunk]
+        if report["failed"]:
+            max_chunk_size = max(max(len(chunk) for chunk in report["failed"]) // 2, 1)
+        if bets_to_pay_out:
+            logging.error(f"Payout failed for bets {bets_to_pay_out} (attempt {attempt + 1})")
 
+    return bets_to_pay_out
 
-if __name__ == "__main__":
-    logging.info("Starting pools grading cron job")
-    graded_pools = grade_pending_pools()
-    logging.info("Finished pools grading cron job")
 
-    logging.info(f"Graded pools: {graded_pools}")
-
-    if graded_pools:
-        print(f"graded_pools: {graded_pools}")
-        time.sleep(1 * 60)
+def pay_out_and_announce(graded_pools):
+    """Pay out the bets of newly graded pools and tweet their results"""
+    if not graded_pools:
+        return
+    print(f"graded_pools: {graded_pools}")
+    time.sleep(1 * 60)
+    with start_trace("pay_out_and_announce", pool_ids=",".join(graded_pools)):
         logging.info(f"Starting paying out bets")
         pay_out_bets(list(graded_pools.keys()))
         logging.info(f"Finished paying out bets")
 
         logging.info("Tweeting for the graded pools")
         post_close_market_tweets(graded_pools, FRONTEND_URL_PREFIX)
+
+
+if __name__ == "__main__":
+    logging.info("Starting pools grading cron job")
+    graded_pools = grade_pending_pools()
+    logging.info("Finished pools grading cron job")
+
+    logging.info(f"Graded pools: {graded_pools}")
+
+    pay_out_and_announce(graded_pools)
@@ -1,24 +1,91 @@
-from langchain_openai import ChatOpenAI
+import functools
 import os
+import threading
 from dotenv import load_dotenv
 
 load_dotenv()
 
-big_llm = ChatOpenAI(
-    # base_url="https://openrouter.ai/api/v1",
-    model="gpt-4o",
-    # model="perplexity/sonar-medium-online",
-    temperature=0.2,
-    api_key=os.getenv("OPENAI_API_KEY"),
-)
-smol_llm = ChatOpenAI(
-    model="gpt-4o-mini",
-    temperature=0.2,
-    api_key=os.getenv("OPENAI_API_KEY"),
-)
-perplexity_llm = ChatOpenAI(
-    base_url="https://api.perplexity.ai",
-    model="sonar-pro",
-    temperature=0,
-    api_key=os.getenv("PPLX_API_KEY"),
-)
+
+def lazy(factory):
+    """
+    Turn a zero-argument factory into an accessor that builds its resource on first call and then reuses it.
+    Used for clients that are expensive to import or construct, so short-lived processes only pay for what they use.
+    """
+    lock = threading.Lock()
+    instance = []
+
+    @functools.wraps(factory)
+    def accessor():
+        if not instance:
+            with lock:
+                if not instance:
+                    instance.append(factory())
+        return instance[0]
+
+    return accessor
+
+
+@lazy
+def get_big_llm():
+    from langchain_openai import ChatOpenAI
+
+    return ChatOpenAI(
+        # base_url="https://openrouter.ai/api/v1",
+        model="gpt-4o",
+        # model="perplexity/sonar-medium-online",
+        temperature=0.2,
+        api_key=os.getenv("OPENAI_API_KEY"),
+    )
+
+
+@lazy
+def get_smol_llm():
+    from langchain_openai import ChatOpenAI
+
+    return ChatOpenAI(
+        model="gpt-4o-mini",
+        temperature=0.2,
+        api_key=os.getenv("OPENAI_API_KEY"),
+    )
+
+
+@lazy
+def get_perplexity_llm():
+    from langchain_openai import ChatOpenAI
+
+    return ChatOpenAI(
+        base_url="https://api.perplexity.ai",
+        model="sonar-pro",
+        temperature=0,
+        api_key=os.getenv("PPLX_API_KEY"),
+    )
+
+
+@lazy
+def get_cached_big_llm():
+    """get_big_llm with the exact-match response cache (db/llm_cache.py), for calls fully determined by their prompt"""
+    from db.llm_cache import get_llm_cache
+
+    return get_big_llm().model_copy(update={"cache": get_llm_cache()})
+
+
+@lazy
+def get_cached_smol_llm():
+    """get_smol_llm with the exact-match response cache (db/llm_cache.py), for calls fully determined by their prompt"""
+    from db.llm_cache import get_llm_cache
+
+    return get_smol_llm().model_copy(update={"cache": get_llm_cache()})
+
+
+_LAZY_ATTRIBUTES = {
+    "big_llm": get_big_llm,
+    "smol_llm": get_smol_llm,
+    "perplexity_llm": get_perplexity_llm,
+}
+
+
+def __getattr__(name):
+    # Keeps `common.big_llm` and friends working, built on first access
+    if name in _LAZY_ATTRIBUTES:
+        return _LAZY_ATTRIBUTES[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
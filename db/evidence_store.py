@@ -0,0 +1,119 @@
+# Evidence the grader has gathered for each pool, so re-grading an unresolved pool only searches for and summarizes
+# sources it hasn't seen before, and grades on everything found so far.
+#
+# Each source keeps a hash of the page content it was summarized from, so a page that changed (an official results
+# page once results are published) is summarized again. Rows older than the caller's max age are dropped.
+
+import hashlib
+import sqlite3
+import time
+from typing import List
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha1((content or "").encode()).hexdigest()
+
+
+class EvidenceStore:
+    def __init__(self, db_path: str = "evidence.db"):
+        self.db_path = db_path
+        self.init_db()
+
+    def init_db(self):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS evidence (
+                    pool_id TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    summary TEXT NOT NULL,
+                    search_query TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    content_hash TEXT,
+                    PRIMARY KEY (pool_id, url)
+                )
+            """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS evidence_queries (
+                    pool_id TEXT NOT NULL,
+                    search_query TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    reuses INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (pool_id, search_query)
+                )
+            """
+            )
+            # Databases created before content hashes and query reuse counts were tracked
+            self._add_missing_column(conn, "evidence", "content_hash", "TEXT")
+            self._add_missing_column(conn, "evidence_queries", "reuses", "INTEGER NOT NULL DEFAULT 0")
+
+    @staticmethod
+    def _add_missing_column(conn, table, column, definition):
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def get_evidence(self, pool_id: str) -> List[dict]:
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.execute(
+                "SELECT url, summary, search_query, fetched_at, content_hash FROM evidence WHERE pool_id = ? "
+                "ORDER BY fetched_at, url",
+                (pool_id,),
+            )
+            return [
+                {
+                    "url": url,
+                    "summary": summary,
+                    "search_query": search_query,
+                    "fetched_at": fetched_at,
+                    "content_hash": stored_hash,
+                }
+                for url, summary, search_query, fetched_at, stored_hash in cursor.fetchall()
+            ]
+
+    def add_evidence(self, pool_id: str, evidence: List[dict]):
+        """Store summarized sources, replacing earlier summaries of the same URL"""
+        fetched_at = time.time()
+        with sqlite3.connect(self.db_path) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO evidence (pool_id, url, summary, search_query, fetched_at, content_hash) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (pool_id, item["url"], item["summary"], item["search_query"], fetched_at, item.get("content_hash"))
+                    for item in evidence
+                ],
+            )
+
+    def get_queries(self, pool_id: str) -> List[dict]:
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.execute(
+                "SELECT search_query, created_at, reuses FROM evidence_queries WHERE pool_id = ? "
+                "ORDER BY created_at, search_query",
+                (pool_id,),
+            )
+            return [
+                {"search_query": search_query, "created_at": created_at, "reuses": reuses}
+                for search_query, created_at, reuses in cursor.fetchall()
+            ]
+
+    def mark_queries_reused(self, pool_id: str):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("UPDATE evidence_queries SET reuses = reuses + 1 WHERE pool_id = ?", (pool_id,))
+
+    def replace_queries(self, pool_id: str, search_queries: List[str]):
+        created_at = time.time()
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("DELETE FROM evidence_queries WHERE pool_id = ?", (pool_id,))
+            conn.executemany(
+                "INSERT OR IGNORE INTO evidence_queries (pool_id, search_query, created_at) VALUES (?, ?, ?)",
+                [(pool_id, search_query, created_at) for search_query in search_queries],
+            )
+
+    def expire(self, max_age: float):
+        """Drop evidence and queries of every pool older than max_age seconds"""
+        cutoff = time.time() - max_age
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("DELETE FROM evidence WHERE fetched_at < ?", (cutoff,))
+            conn.execute("DELETE FROM evidence_queries WHERE created_at < ?", (cutoff,))
@@ -0,0 +1,158 @@
+# Exact-match response cache for LangChain chat model calls.
+#
+# Entries are keyed on a hash of the model's serialized parameters (model name, temperature, bound tools/schema) and
+# the prompt messages, so only calls with identical inputs share a response. Caching is opt-in: a node uses it by
+# calling a model copy that has the cache attached (see get_cached_smol_llm/get_cached_big_llm in common.py).
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Optional, Sequence
+from dotenv import load_dotenv
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+from db.redis import get_redis_client
+
+load_dotenv()
+
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "sqlite")  # "sqlite" or "redis"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.db")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 24 * 60 * 60))
+# Least recently used entries are evicted above this many entries
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 10000))
+LLM_CACHE_KEY_PREFIX = "llm_cache:"
+LLM_CACHE_INDEX_KEY = "llm_cache:last_used"
+
+
+def _cache_key(prompt: str, llm_string: str) -> str:
+    return hashlib.sha256(f"{llm_string}\n{prompt}".encode()).hexdigest()
+
+
+def _dump_generations(return_val: Sequence[Any]) -> str:
+    return json.dumps([dumps(generation) for generation in return_val])
+
+
+def _load_generations(value: str) -> Optional[list]:
+    """Load cached generations, flagging their messages with response_metadata["cache_hit"] for callbacks"""
+    try:
+        generations = [loads(generation) for generation in json.loads(value)]
+    except Exception as e:
+        print(f"Error loading cached LLM response: {str(e)}")
+        return None
+    for generation in generations:
+        message = getattr(generation, "message", None)
+        if message is not None:
+            message.response_metadata = {**(message.response_metadata or {}), "cache_hit": True}
+    return generations
+
+
+class SQLiteLLMCache(BaseCache):
+    def __init__(self, db_path: str = LLM_CACHE_PATH, ttl: int = LLM_CACHE_TTL, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.init_db()
+
+    def init_db(self):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL
+                )
+            """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_used_at ON llm_cache (last_used_at)")
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[list]:
+        key = _cache_key(prompt, llm_string)
+        now = time.time()
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT value FROM llm_cache WHERE key = ? AND created_at > ?", (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE llm_cache SET last_used_at = ? WHERE key = ?", (now, key))
+        return _load_generations(row[0])
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Any]) -> None:
+        now = time.time()
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at, last_used_at) VALUES (?, ?, ?, ?)",
+                (_cache_key(prompt, llm_string), _dump_generations(return_val), now, now),
+            )
+            conn.execute("DELETE FROM llm_cache WHERE created_at <= ?", (now - self.ttl,))
+            conn.execute(
+                """
+                DELETE FROM llm_cache WHERE key IN (
+                    SELECT key FROM llm_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+                )
+            """,
+                (self.max_entries,),
+            )
+
+    def clear(self, **kwargs: Any) -> None:
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("DELETE FROM llm_cache")
+
+
+class RedisLLMCache(BaseCache):
+    """Shares cached responses between processes. Recency is tracked in a sorted set to bound the number of entries"""
+
+    def __init__(self, ttl: int = LLM_CACHE_TTL, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[list]:
+        key = LLM_CACHE_KEY_PREFIX + _cache_key(prompt, llm_string)
+        try:
+            redis_client = get_redis_client()
+            value = redis_client.get(key)
+            if value is None:
+                return None
+            redis_client.zadd(LLM_CACHE_INDEX_KEY, {key: time.time()})
+        except Exception as e:
+            # A cache outage shouldn't fail the LLM call
+            print(f"Error reading LLM cache: {str(e)}")
+            return None
+        return _load_generations(value)
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Any]) -> None:
+        key = LLM_CACHE_KEY_PREFIX + _cache_key(prompt, llm_string)
+        now = time.time()
+        try:
+            redis_client = get_redis_client()
+            pipeline = redis_client.pipeline(transaction=False)
+            pipeline.set(key, _dump_generations(return_val), ex=self.ttl)
+            pipeline.zadd(LLM_CACHE_INDEX_KEY, {key: now})
+            # Entries not used within the TTL have already expired
+            pipeline.zremrangebyscore(LLM_CACHE_INDEX_KEY, "-inf", now - self.ttl)
+            pipeline.zcard(LLM_CACHE_INDEX_KEY)
+            entries = pipeline.execute()[-1]
+
+            if entries > self.max_entries:
+                evicted = redis_client.zpopmin(LLM_CACHE_INDEX_KEY, entries - self.max_entries)
+                if evicted:
+                    redis_client.unlink(*[evicted_key for evicted_key, _ in evicted])
+        except Exception as e:
+            print(f"Error writing LLM cache: {str(e)}")
+
+    def clear(self, **kwargs: Any) -> None:
+        redis_client = get_redis_client()
+        keys = redis_client.zrange(LLM_CACHE_INDEX_KEY, 0, -1)
+        if keys:
+            redis_client.unlink(*keys)
+        redis_client.unlink(LLM_CACHE_INDEX_KEY)
+
+
+def get_llm_cache() -> BaseCache:
+    if LLM_CACHE_BACKEND == "redis":
+        return RedisLLMCache()
+    return SQLiteLLMCache()
@@ -1,5 +1,13 @@
 import os
+import threading
+import weakref
+import asyncio
 import redis
+import redis.asyncio
+from redis.asyncio.retry import Retry as AsyncRetry
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ConnectionError, TimeoutError
+from redis.retry import Retry
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -10,15 +18,74 @@ REDIS_PORT = int(os.getenv('REDIS_PORT', '25061'))
 REDIS_USERNAME = os.getenv('REDIS_USERNAME')
 REDIS_PASSWORD = os.getenv('REDIS_PASSWORD')
 REDIS_USE_TLS = os.getenv('REDIS_USE_TLS', 'true').lower() == 'true'
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', '20'))
+# Seconds to wait for a pooled connection to be returned once all REDIS_MAX_CONNECTIONS are in use, before raising
+REDIS_POOL_TIMEOUT = int(os.getenv('REDIS_POOL_TIMEOUT', '20'))
+# Idle connections are PINGed before reuse if they haven't been used for this many seconds
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', '30'))
+REDIS_RETRIES = int(os.getenv('REDIS_RETRIES', '3'))
 
-def get_redis_client():
-	return redis.Redis(
+_pool = None
+_pool_lock = threading.Lock()
+# asyncio connections belong to the event loop that opened them, so there is one async pool per loop
+_async_pools = weakref.WeakKeyDictionary()
+
+
+def _connection_kwargs(ssl_connection_class, retry_class):
+	kwargs = dict(
 		host=REDIS_HOST,
 		port=REDIS_PORT,
 		username=REDIS_USERNAME,
 		password=REDIS_PASSWORD,
-		ssl=REDIS_USE_TLS,
-		ssl_cert_reqs=None,
-		decode_responses=True
+		decode_responses=True,
+		max_connections=REDIS_MAX_CONNECTIONS,
+		timeout=REDIS_POOL_TIMEOUT,
+		health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+		socket_keepalive=True,
+		# Reconnect and retry commands when a pooled connection was dropped by the server
+		retry=retry_class(ExponentialBackoff(cap=2, base=0.1), REDIS_RETRIES),
+		retry_on_error=[ConnectionError, TimeoutError],
 	)
+	if REDIS_USE_TLS:
+		kwargs.update(connection_class=ssl_connection_class, ssl_cert_reqs=None)
+	return kwargs
+
+
+def get_redis_client():
+	"""
+	Returns a client backed by a process-wide connection pool, so the TLS handshake is paid once per connection
+	rather than once per call. Calling close() on the client returns its connection to the pool. When every connection
+	is in use, callers wait up to REDIS_POOL_TIMEOUT seconds for one instead of failing right away.
+	"""
+	global _pool
+	if _pool is None:
+		with _pool_lock:
+			if _pool is None:
+				_pool = redis.BlockingConnectionPool(**_connection_kwargs(redis.SSLConnection, Retry))
+	return redis.Redis(connection_pool=_pool)
+
+
+def get_async_redis_client():
+	"""asyncio variant of get_redis_client, pooled per running event loop"""
+	loop = asyncio.get_running_loop()
+	pool = _async_pools.get(loop)
+	if pool is None:
+		pool = redis.asyncio.BlockingConnectionPool(**_connection_kwargs(redis.asyncio.SSLConnection, AsyncRetry))
+		_async_pools[loop] = pool
+	return redis.asyncio.Redis(connection_pool=pool)
+
+
+def get_many(redis_client, keys):
+	"""Read several string keys in one round-trip. Returns a dict of key to value (None if missing)"""
+	keys = list(keys)
+	if not keys:
+		return {}
+	return dict(zip(keys, redis_client.mget(keys)))
+
 
+def set_many(redis_client, mapping, ex=None):
+	"""Write several string keys, each with the same optional expiry, in one round-trip"""
+	pipeline = redis_client.pipeline(transaction=False)
+	for key, value in mapping.items():
+		pipeline.set(key, value, ex=ex)
+	return pipeline.execute()
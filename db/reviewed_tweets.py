@@ -0,0 +1,79 @@
+# Tracks which mentions have already been handled.
+#
+# Reviewed tweet IDs are written to a set per POLLING_WINDOW-sized time bucket, keyed by the time they were reviewed.
+# The mentions API only returns tweets from the last POLLING_WINDOW seconds, so any tweet we see again must have been
+# reviewed in the current or the previous bucket, and older buckets can expire. Lookups use SMISMEMBER on the candidate
+# IDs only, so each poll costs the same no matter how many tweets the bot has handled over its lifetime.
+
+import os
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+POLLING_WINDOW = int(os.getenv("POLLING_WINDOW", 3600))
+REVIEWED_TWEETS_KEY_PREFIX = "reviewed_tweets:"
+# The set used before bucketing. It is still checked until the bucketed sets cover a full polling window, then deleted.
+LEGACY_REVIEWED_TWEETS_KEY = "reviewed_tweets"
+BUCKETS_STARTED_AT_KEY = "reviewed_tweets:started_at"
+
+_legacy_retired = False
+
+
+def _bucket(timestamp):
+    return int(timestamp // POLLING_WINDOW)
+
+
+def _bucket_key(bucket):
+    return f"{REVIEWED_TWEETS_KEY_PREFIX}{bucket}"
+
+
+def filter_unreviewed(redis_client, tweet_ids, now=None):
+    """Returns the tweet IDs, in order, that haven't been reviewed yet"""
+    global _legacy_retired
+
+    tweet_ids = list(tweet_ids)
+    if not tweet_ids:
+        return []
+    now = now or time.time()
+
+    keys = [_bucket_key(_bucket(now)), _bucket_key(_bucket(now) - 1)]
+    if not _legacy_retired:
+        keys.append(LEGACY_REVIEWED_TWEETS_KEY)
+
+    pipeline = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipeline.smismember(key, tweet_ids)
+    if not _legacy_retired:
+        pipeline.get(BUCKETS_STARTED_AT_KEY)
+    results = pipeline.execute()
+
+    if not _legacy_retired:
+        started_at = results.pop()
+        if started_at is not None and now - float(started_at) > POLLING_WINDOW:
+            print("Bucketed reviewed tweets cover a full polling window, deleting the legacy reviewed_tweets set")
+            redis_client.unlink(LEGACY_REVIEWED_TWEETS_KEY)
+            _legacy_retired = True
+
+    return [
+        tweet_id
+        for i, tweet_id in enumerate(tweet_ids)
+        if not any(memberships[i] for memberships in results)
+    ]
+
+
+def mark_reviewed(redis_client, tweet_ids, now=None):
+    """Records tweet IDs as reviewed in the current bucket"""
+    tweet_ids = list(tweet_ids)
+    if not tweet_ids:
+        return
+    now = now or time.time()
+    bucket = _bucket(now)
+    key = _bucket_key(bucket)
+
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.sadd(key, *tweet_ids)
+    # The bucket is last read during the bucket after it, so expire it once that one ends
+    pipeline.expireat(key, (bucket + 2) * POLLING_WINDOW + 60)
+    pipeline.set(BUCKETS_STARTED_AT_KEY, now, nx=True)
+    pipeline.execute()
@@ -23,11 +23,18 @@ ssh "$deploy_acct" <<ENDSSH
   source .venv/bin/activate
   pip install -r requirements.txt
 	sudo cp deploy/promptbet-agent.service /etc/systemd/system/promptbet-agent.service
-	sudo cp deploy/promptbet-agent.timer /etc/systemd/system/promptbet-agent.timer
 	sudo cp deploy/promptbet-agent-grader.service /etc/systemd/system/promptbet-agent-grader.service
 	sudo cp deploy/promptbet-agent-grader.timer /etc/systemd/system/promptbet-agent-grader.timer
+	sudo cp deploy/promptbet-agent-grading-scheduler.service /etc/systemd/system/promptbet-agent-grading-scheduler.service
 	sudo cp deploy/promptbet-telegram.service /etc/systemd/system/promptbet-telegram.service
 	sudo systemctl daemon-reload
+	# The mention poller used to run once a minute from a timer, it is now a long-running service
+	sudo systemctl disable --now promptbet-agent.timer || true
+	sudo rm -f /etc/systemd/system/promptbet-agent.timer
+	sudo systemctl enable promptbet-agent.service
+	sudo systemctl restart promptbet-agent.service
+	sudo systemctl enable promptbet-agent-grading-scheduler.service
+	sudo systemctl restart promptbet-agent-grading-scheduler.service
 ENDSSH
 
 # docker compose down
@@ -0,0 +1,6 @@
+#! /bin/bash
+
+project_dir="/home/ubuntu/promptbet-agent"
+
+source "$project_dir/.env"
+exec "$project_dir/.venv/bin/python3" "$project_dir/grading_scheduler.py"
@@ -0,0 +1,136 @@
+"""
+When each pending pool should next be graded.
+
+New pools are added with their betsCloseAt as the first check time, from create_pool and from the subgraph.
+After a pool is graded "not resolved yet", its next check time is taken from the grader's estimate of when official
+results will be available, or falls back to exponential backoff. The grading scheduler wakes up when the earliest
+check is due, and the grading cron skips pools whose next check hasn't arrived.
+Check times live in a Redis sorted set (pool ID -> Unix time) and unresolved attempts in a hash.
+
+A pool is graded by whoever holds its lease, so the scheduler and the cron, or a scheduler restarted mid-grade,
+never grade the same pool at the same time. A lease that isn't released (a crash) expires after GRADING_LEASE_TTL.
+"""
+
+import os
+import socket
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+GRADING_SCHEDULE_KEY = "GRADING_SCHEDULE"
+GRADING_ATTEMPTS_KEY = "GRADING_ATTEMPTS"
+GRADING_LEASE_KEY_PREFIX = "GRADING_LEASE:"
+# Pushed to when a pool is added, so the scheduler can wake up and recompute when to fire next
+GRADING_WAKEUP_KEY = "GRADING_WAKEUP"
+GRADING_LEASE_TTL = int(os.getenv("GRADING_LEASE_TTL", 30 * 60))
+# Backoff after the first unresolved attempt, doubling after each one, in seconds
+GRADING_RECHECK_BASE = int(os.getenv("GRADING_RECHECK_BASE", 60 * 60))
+# Bounds on any next check, including the grader's own estimate
+GRADING_RECHECK_MIN = int(os.getenv("GRADING_RECHECK_MIN", 15 * 60))
+GRADING_RECHECK_MAX = int(os.getenv("GRADING_RECHECK_MAX", 24 * 60 * 60))
+
+# Identifies this process as a lease holder
+LEASE_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+# Delete a lease only if this process still holds it
+_RELEASE_LEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+def add_pools(redis_client, bets_close_at_by_pool_id):
+    """
+    Schedule the first check of new pools at their betsCloseAt.
+    Pools that are already scheduled keep their current check time.
+    """
+    if not bets_close_at_by_pool_id:
+        return
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.zadd(
+        GRADING_SCHEDULE_KEY,
+        {str(pool_id): int(bets_close_at) for pool_id, bets_close_at in bets_close_at_by_pool_id.items()},
+        nx=True,
+    )
+    pipeline.lpush(GRADING_WAKEUP_KEY, 1)
+    pipeline.ltrim(GRADING_WAKEUP_KEY, 0, 0)
+    pipeline.execute()
+
+
+def next_check(redis_client):
+    """Returns (pool_id, check time) of the earliest scheduled check, or None if nothing is scheduled"""
+    earliest = redis_client.zrange(GRADING_SCHEDULE_KEY, 0, 0, withscores=True)
+    return earliest[0] if earliest else None
+
+
+def due_pool_ids_from_schedule(redis_client, limit, now=None):
+    """Returns up to `limit` pool IDs whose check time has arrived, earliest first"""
+    return redis_client.zrangebyscore(GRADING_SCHEDULE_KEY, "-inf", now or time.time(), start=0, num=limit)
+
+
+def claim_pool(redis_client, pool_id, now=None):
+    """
+    Take the lease on grading a pool. Returns False if another process holds it.
+    Claiming a pool this process already holds renews the lease. The pool's next check is pushed past the lease,
+    so it comes due again only if the lease expires without the grading outcome being recorded.
+    """
+    now = now or time.time()
+    lease_key = f"{GRADING_LEASE_KEY_PREFIX}{pool_id}"
+    if not redis_client.set(lease_key, LEASE_OWNER, nx=True, ex=GRADING_LEASE_TTL):
+        if redis_client.get(lease_key) != LEASE_OWNER:
+            return False
+        redis_client.expire(lease_key, GRADING_LEASE_TTL)
+    redis_client.zadd(GRADING_SCHEDULE_KEY, {str(pool_id): now + GRADING_LEASE_TTL}, xx=True)
+    return True
+
+
+def release_pools(redis_client, pool_ids):
+    """Release the leases this process holds on `pool_ids`"""
+    for pool_id in pool_ids:
+        redis_client.eval(_RELEASE_LEASE_SCRIPT, 1, f"{GRADING_LEASE_KEY_PREFIX}{pool_id}", LEASE_OWNER)
+
+
+def due_pool_ids(redis_client, pool_ids, now=None):
+    """Returns the pool IDs, in order, that have no scheduled check or whose check time has arrived"""
+    pool_ids = [str(pool_id) for pool_id in pool_ids]
+    if not pool_ids:
+        return []
+    now = now or time.time()
+    check_times = redis_client.zmscore(GRADING_SCHEDULE_KEY, pool_ids)
+    return [
+        pool_id
+        for pool_id, check_time in zip(pool_ids, check_times)
+        if check_time is None or check_time <= now
+    ]
+
+
+def schedule_next_check(redis_client, pool_id, next_check_at=None, now=None, count_attempt=True):
+    """
+    Schedule the next grading of an unresolved pool at `next_check_at` (the grader's estimate) if given,
+    otherwise after an exponential backoff. Returns the scheduled Unix time.
+    Pass count_attempt=False when the pool wasn't actually graded, so the backoff doesn't grow.
+    """
+    now = now or time.time()
+    if count_attempt:
+        attempts = redis_client.hincrby(GRADING_ATTEMPTS_KEY, str(pool_id), 1)
+    else:
+        attempts = int(redis_client.hget(GRADING_ATTEMPTS_KEY, str(pool_id)) or 1)
+    if next_check_at is None:
+        next_check_at = now + GRADING_RECHECK_BASE * 2 ** min(attempts - 1, 16)
+    next_check_at = min(max(next_check_at, now + GRADING_RECHECK_MIN), now + GRADING_RECHECK_MAX)
+    redis_client.zadd(GRADING_SCHEDULE_KEY, {str(pool_id): next_check_at})
+    return next_check_at
+
+
+def clear_schedule(redis_client, pool_ids):
+    """Forget the schedule of pools that no longer need grading"""
+    pool_ids = [str(pool_id) for pool_id in pool_ids]
+    if not pool_ids:
+        return
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.zrem(GRADING_SCHEDULE_KEY, *pool_ids)
+    pipeline.hdel(GRADING_ATTEMPTS_KEY, *pool_ids)
+    pipeline.execute()
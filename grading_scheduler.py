@@ -0,0 +1,151 @@
+"""
+Resident grading scheduler. Grades each pool as soon as its check is due (betsCloseAt for a new pool, then whatever
+grading_schedule.py sets after an unresolved grade), instead of waiting for the next run of the grading cron.
+
+Pools are fed into the schedule by create_pool and by a periodic sync of pending pools from the subgraph, which also
+picks up pools created elsewhere. Pools are leased before grading, so a restart or the cron can't grade one twice.
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import time
+from betting_pool_grading_cron import (
+    GRADING_CONCURRENCY,
+    GRADING_POOL_FIELDS,
+    grade_pools,
+    pay_out_and_announce,
+)
+from db.redis import get_async_redis_client, get_redis_client
+from grading_schedule import (
+    GRADING_WAKEUP_KEY,
+    add_pools,
+    claim_pool,
+    clear_schedule,
+    due_pool_ids_from_schedule,
+    next_check,
+    release_pools,
+)
+from subgraph import fetch_pending_pools_by_id, iter_pending_pools
+
+# Seconds between syncs of pending pools from the subgraph
+GRADING_SCHEDULER_RESYNC_INTERVAL = int(os.getenv("GRADING_SCHEDULER_RESYNC_INTERVAL", 60 * 60))
+# Longest the scheduler sleeps without checking the schedule, in case a wakeup is missed
+GRADING_SCHEDULER_MAX_SLEEP = int(os.getenv("GRADING_SCHEDULER_MAX_SLEEP", 5 * 60))
+# Max due pools handed to the grader at once
+GRADING_SCHEDULER_BATCH_SIZE = int(os.getenv("GRADING_SCHEDULER_BATCH_SIZE", 50))
+# Seconds to wait before retrying after the schedule or the subgraph couldn't be read
+GRADING_SCHEDULER_ERROR_BACKOFF = int(os.getenv("GRADING_SCHEDULER_ERROR_BACKOFF", 30))
+
+
+def sync_from_subgraph(redis_client):
+    """Add every pending pool to the schedule, at its betsCloseAt unless it's already scheduled"""
+    bets_close_at_by_pool_id = {
+        pool["id"]: pool["betsCloseAt"] for pool in iter_pending_pools(fields=("id", "betsCloseAt"))
+    }
+    add_pools(redis_client, bets_close_at_by_pool_id)
+    logging.info(f"Synced {len(bets_close_at_by_pool_id)} pending pools into the grading schedule")
+
+
+def claim_due_pools(redis_client):
+    """Lease the pools whose check is due and fetch them. Pools that are no longer pending are unscheduled"""
+    claimed = [
+        pool_id
+        for pool_id in due_pool_ids_from_schedule(redis_client, GRADING_SCHEDULER_BATCH_SIZE)
+        if claim_pool(redis_client, pool_id)
+    ]
+    if not claimed:
+        return []
+
+    try:
+        pools = fetch_pending_pools_by_id(claimed, fields=GRADING_POOL_FIELDS)
+    except Exception:
+        release_pools(redis_client, claimed)
+        raise
+
+    not_pending = set(claimed) - {pool["id"] for pool in pools}
+    if not_pending:
+        logging.info(f"Pools {sorted(not_pending)} are no longer pending, removing them from the grading schedule")
+        clear_schedule(redis_client, not_pending)
+        release_pools(redis_client, not_pending)
+    return pools
+
+
+async def grade_and_pay_out(pools):
+    try:
+        graded_pools = await grade_pools(pools, GRADING_CONCURRENCY, check_schedule=False)
+        logging.info(f"Graded pools: {graded_pools}")
+        await asyncio.to_thread(pay_out_and_announce, graded_pools)
+    except Exception as e:
+        logging.error(f"Error grading pools {[pool['id'] for pool in pools]}: {str(e)}")
+
+
+async def wait_for_wakeup(stop, timeout):
+    """Sleep up to `timeout` seconds, waking early when a pool is added to the schedule or on shutdown"""
+    wakeup = asyncio.create_task(
+        get_async_redis_client().blpop([GRADING_WAKEUP_KEY], timeout=max(timeout, 0.1))
+    )
+    stopped = asyncio.create_task(stop.wait())
+    await asyncio.wait({wakeup, stopped}, timeout=timeout + 5, return_when=asyncio.FIRST_COMPLETED)
+    failed = wakeup.done() and not wakeup.cancelled() and wakeup.exception() is not None
+    for task in (wakeup, stopped):
+        task.cancel()
+    await asyncio.gather(wakeup, stopped, return_exceptions=True)
+
+    if failed:
+        # Without Redis there's nothing to wake up for, so just sleep
+        logging.error(f"Error waiting for grading schedule changes: {str(wakeup.exception())}")
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_grading_scheduler():
+    """
+    Wake up when the earliest scheduled check is due and grade the pools that are due, in the background so pools
+    coming due in the meantime aren't held up. On SIGTERM/SIGINT, grading in progress is allowed to finish.
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    redis_client = get_redis_client()
+    in_flight = set()
+    synced_at = None
+    logging.info("Grading scheduler started")
+    while not stop.is_set():
+        try:
+            if synced_at is None or time.time() - synced_at >= GRADING_SCHEDULER_RESYNC_INTERVAL:
+                await asyncio.to_thread(sync_from_subgraph, redis_client)
+                synced_at = time.time()
+
+            pools = await asyncio.to_thread(claim_due_pools, redis_client)
+            if pools:
+                logging.info(f"Grading {len(pools)} due pools: {[pool['id'] for pool in pools]}")
+                task = asyncio.create_task(grade_and_pay_out(pools))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+                continue
+
+            earliest = await asyncio.to_thread(next_check, redis_client)
+            timeout = min(GRADING_SCHEDULER_MAX_SLEEP, synced_at + GRADING_SCHEDULER_RESYNC_INTERVAL - time.time())
+            if earliest is not None:
+                timeout = min(timeout, earliest[1] - time.time())
+        except Exception as e:
+            logging.error(f"Error in grading scheduler: {str(e)}")
+            timeout = GRADING_SCHEDULER_ERROR_BACKOFF
+
+        # At least a second, so a due pool leased by another process is not polled in a tight loop
+        await wait_for_wakeup(stop, max(timeout, 1))
+
+    if in_flight:
+        logging.info(f"Waiting for {len(in_flight)} grading batches to finish")
+        await asyncio.gather(*in_flight, return_exceptions=True)
+    logging.info("Grading scheduler stopped")
+
+
+if __name__ == "__main__":
+    asyncio.run(run_grading_scheduler())
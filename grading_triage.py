@@ -0,0 +1,81 @@
+"""
+Decides from a pool's own fields whether it's worth running the grader graph on it now.
+
+grade_pool_with_langgraph_agent only keeps a result from before the pool's decision date when the grader finds the
+question's time period already over with official results available. That can only happen for questions that can
+resolve early ("by", "before", ...). Pools whose decision date is ahead and whose question can't resolve early are
+skipped without running the graph. Ambiguous wording is graded by default; set GRADING_TRIAGE_LLM=true to have a
+small LLM classifier settle it instead, at the cost of one extra LLM call per ambiguous pool.
+"""
+
+import os
+import re
+import time
+from pydantic import BaseModel
+from dotenv import load_dotenv
+from common import get_cached_smol_llm
+from provider_limits import async_provider_slot
+
+load_dotenv()
+
+# Off by default: ambiguous pools are graded. Set GRADING_TRIAGE_LLM=true to classify them with the smol LLM first
+GRADING_TRIAGE_LLM = os.getenv("GRADING_TRIAGE_LLM", "false").lower() == "true"
+
+# Wording that suggests the outcome may be settled before the decision date
+EARLY_RESOLUTION_PATTERN = re.compile(
+    r"\b(by|before|until|till|prior to|ahead of|no later than|at any (point|time))\b", re.IGNORECASE
+)
+
+
+class EarlyResolutionClassification(BaseModel):
+    can_resolve_early: bool
+
+
+def triage_by_rules(pool, now=None):
+    """Returns (should_grade, reason), with should_grade None when the question needs a closer look"""
+    now = now or time.time()
+    if int(pool["decisionDate"]) <= now:
+        return True, "decision date has passed"
+    if EARLY_RESOLUTION_PATTERN.search(pool["question"]):
+        return None, "decision date is ahead, but the question may resolve early"
+    return False, "decision date is ahead and the question can't resolve early"
+
+
+async def classify_early_resolution(pool):
+    """Ask smol_llm whether the question's outcome could be known for certain before its decision date"""
+    prompt = f"""
+    A betting pool asks: "{pool['question']}"
+    Its options are: {pool['options']}
+    It is decided on {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(int(pool['decisionDate'])))} UTC.
+
+    Could the winning option become known for certain before that date? For example, "Will Bitcoin reach $100,000 by
+    December 31?" is settled as soon as it reaches $100,000, but "Will Bitcoin be above $100,000 on December 31?" is not.
+
+    Your response should be the following JSON object and nothing else. Do not include any other text, any markdown, or any comments.
+    {{
+        "can_resolve_early": true/false
+    }}
+    """
+
+    # The answer only depends on the pool, so re-checks are answered from the LLM cache
+    structured_llm = get_cached_smol_llm().with_structured_output(EarlyResolutionClassification)
+    async with async_provider_slot("llm"):
+        result = await structured_llm.ainvoke(prompt)
+    return result.can_resolve_early
+
+
+async def triage_pool(pool, now=None):
+    """Returns (should_grade, reason)"""
+    should_grade, reason = triage_by_rules(pool, now)
+    if should_grade is not None:
+        return should_grade, reason
+    if not GRADING_TRIAGE_LLM:
+        return True, reason
+
+    try:
+        if await classify_early_resolution(pool):
+            return True, "decision date is ahead, but the question can resolve early"
+        return False, "decision date is ahead and the classifier says the question can't resolve early"
+    except Exception as e:
+        print(f"Error classifying pool {pool['id']}: {str(e)}")
+        return True, reason
@@ -0,0 +1,307 @@
+"""
+LangChain callbacks that record where the agents spend time and tokens.
+
+Pass get_callbacks() in the config of every graph run. Calls are attributed to the graph node they ran in
+(the `langgraph_node` metadata LangGraph adds to each run), or to the run name outside a graph.
+
+Every node, LLM call and whole run is appended as one JSON line to AGENT_METRICS_PATH from a background thread
+(rotated past AGENT_METRICS_MAX_BYTES, off if the path is empty). Calls answered from the LLM cache are recorded with
+cached_response and no cost. Summarize them with:
+    python instrumentation.py --by day,node                   # JSON
+    python instrumentation.py --by pool_id --format csv --since 2025-03-01
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from langchain_core.callbacks import BaseCallbackHandler
+from tracing import JsonLinesWriter
+
+AGENT_METRICS_PATH = os.getenv("AGENT_METRICS_PATH", "agent_metrics.jsonl")
+# The metrics file is moved to AGENT_METRICS_PATH.1 (replacing the previous one) once it grows past this many bytes
+AGENT_METRICS_MAX_BYTES = int(os.getenv("AGENT_METRICS_MAX_BYTES", 20 * 1024 * 1024))
+
+# USD per million tokens: (input, cached input, output)
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "sonar-pro": (3.00, 3.00, 15.00),
+}
+REPORT_FIELDS = ("type", "agent", "request_id", "pool_id", "day", "node", "model")
+REPORT_TOTALS = (
+    "runs", "llm_calls", "cached_responses", "seconds", "prompt_tokens", "completion_tokens", "cached_tokens", "cost"
+)
+
+_metrics_writer = None
+_metrics_writer_lock = threading.Lock()
+
+
+def _usage(response):
+    """Returns (input tokens, input tokens served from the provider's prompt cache, output tokens) of an LLMResult"""
+    input_tokens = 0
+    cached_tokens = 0
+    output_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                input_tokens += usage.get("input_tokens", 0)
+                cached_tokens += (usage.get("input_token_details") or {}).get("cache_read", 0) or 0
+                output_tokens += usage.get("output_tokens", 0)
+    if input_tokens:
+        return input_tokens, cached_tokens, output_tokens
+
+    # Older langchain-openai versions only report usage in llm_output
+    token_usage = (response.llm_output or {}).get("token_usage") or {}
+    return (
+        token_usage.get("prompt_tokens", 0),
+        (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0) or 0,
+        token_usage.get("completion_tokens", 0),
+    )
+
+
+def estimate_cost(model, prompt_tokens, cached_tokens, completion_tokens):
+    """Estimated USD cost of an LLM call, or None for a model missing from MODEL_PRICES"""
+    # Dated snapshots (gpt-4o-2024-08-06) are priced like their base model
+    prices = MODEL_PRICES.get(model) or next(
+        (MODEL_PRICES[name] for name in sorted(MODEL_PRICES, key=len, reverse=True) if (model or "").startswith(name)),
+        None,
+    )
+    if prices is None:
+        return None
+    input_price, cached_price, output_price = prices
+    return (
+        (prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price + completion_tokens * output_price
+    ) / 1_000_000
+
+
+def record_metric(event):
+    """Queue one metrics event to be appended to AGENT_METRICS_PATH"""
+    global _metrics_writer
+    if not AGENT_METRICS_PATH:
+        return
+    if _metrics_writer is None:
+        with _metrics_writer_lock:
+            if _metrics_writer is None:
+                _metrics_writer = JsonLinesWriter(AGENT_METRICS_PATH, AGENT_METRICS_MAX_BYTES, name="metrics-writer")
+    _metrics_writer.write(event)
+
+
+def _is_cache_hit(response):
+    """Whether an LLMResult was served by the LLM cache (see db/llm_cache.py), rather than by the provider"""
+    return any(
+        (getattr(getattr(generation, "message", None), "response_metadata", None) or {}).get("cache_hit")
+        for generations in response.generations
+        for generation in generations
+    )
+
+
+class PromptCacheCallbackHandler(BaseCallbackHandler):
+    """Counts, per node, the input tokens sent and how many of them the provider served from its prompt cache"""
+
+    # Cheap enough to run on the event loop instead of in an executor
+    run_inline = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._nodes = {}
+        self._stats = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, name=None, **kwargs):
+        self._nodes[run_id] = (metadata or {}).get("langgraph_node") or name or "unknown"
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        node = self._nodes.pop(run_id, "unknown")
+        if _is_cache_hit(response):
+            # Never reached the provider, so says nothing about its prompt cache
+            return
+        input_tokens, cached_tokens, _ = _usage(response)
+        with self._lock:
+            stats = self._stats.setdefault(node, {"calls": 0, "input_tokens": 0, "cached_tokens": 0})
+            stats["calls"] += 1
+            stats["input_tokens"] += input_tokens
+            stats["cached_tokens"] += cached_tokens
+        print(f"Prompt cache [{node}]: {cached_tokens}/{input_tokens} input tokens cached")
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._nodes.pop(run_id, None)
+
+    def stats(self):
+        """Returns {node: {"calls", "input_tokens", "cached_tokens", "hit_rate"}} for this process"""
+        with self._lock:
+            return {
+                node: dict(stats, hit_rate=stats["cached_tokens"] / stats["input_tokens"] if stats["input_tokens"] else 0)
+                for node, stats in self._stats.items()
+            }
+
+
+class AgentMetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Records the wall time of a graph run, of each of its nodes, and of each LLM call, plus each call's model,
+    token counts and estimated cost. One handler is created per run.
+    """
+
+    run_inline = True
+
+    def __init__(self, agent, request_id=None, pool_id=None):
+        self.agent = agent
+        self.request_id = request_id or uuid.uuid4().hex
+        self.pool_id = pool_id
+        self._runs = {}
+
+    def _record(self, event_type, node, seconds, **fields):
+        now = datetime.now(timezone.utc)
+        record_metric(
+            {
+                "type": event_type,
+                "agent": self.agent,
+                "request_id": self.request_id,
+                "pool_id": self.pool_id,
+                "day": now.strftime("%Y-%m-%d"),
+                "timestamp": now.isoformat(),
+                "node": node,
+                "seconds": round(seconds, 3),
+                **fields,
+            }
+        )
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, metadata=None, name=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        if parent_run_id is None:
+            self._runs[run_id] = ("request", None, time.perf_counter())
+        elif node and name == node:
+            # The node's own run, rather than a runnable nested inside it
+            self._runs[run_id] = ("node", node, time.perf_counter())
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run:
+            event_type, node, started_at = run
+            self._record(event_type, node, time.perf_counter() - started_at)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run:
+            event_type, node, started_at = run
+            self._record(event_type, node, time.perf_counter() - started_at, error=str(error))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, name=None, **kwargs):
+        metadata = metadata or {}
+        invocation_params = kwargs.get("invocation_params") or {}
+        model = metadata.get("ls_model_name") or invocation_params.get("model_name") or invocation_params.get("model")
+        self._runs[run_id] = ("llm", metadata.get("langgraph_node") or name or "unknown", time.perf_counter(), model)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if not run:
+            return
+        _, node, started_at, model = run
+        if _is_cache_hit(response):
+            # The replayed usage is that of the original call; this one cost nothing
+            self._record("llm", node, time.perf_counter() - started_at, model=model, cached_response=True, cost=0)
+            return
+        prompt_tokens, cached_tokens, completion_tokens = _usage(response)
+        self._record(
+            "llm",
+            node,
+            time.perf_counter() - started_at,
+            model=model,
+            prompt_tokens=prompt_tokens,
+            cached_tokens=cached_tokens,
+            completion_tokens=completion_tokens,
+            cost=estimate_cost(model, prompt_tokens, cached_tokens, completion_tokens),
+        )
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run:
+            _, node, started_at, model = run
+            self._record("llm", node, time.perf_counter() - started_at, model=model, error=str(error))
+
+
+prompt_cache_handler = PromptCacheCallbackHandler()
+
+
+def get_callbacks(agent, request_id=None, pool_id=None):
+    """Callbacks to pass in the config of a graph run"""
+    return [prompt_cache_handler, AgentMetricsCallbackHandler(agent, request_id, pool_id)]
+
+
+def load_metrics(path=AGENT_METRICS_PATH, since=None):
+    """Read recorded events, optionally only those from `since` (YYYY-MM-DD) onward"""
+    events = []
+    # The rotated-out file holds the older events
+    for file_path in (f"{path}.1", path):
+        if not os.path.exists(file_path):
+            continue
+        with open(file_path) as metrics_file:
+            for line in metrics_file:
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                if since is None or event["day"] >= since:
+                    events.append(event)
+    return events
+
+
+def aggregate_metrics(events, by, event_type=None):
+    """
+    Sum events grouped by the fields in `by` (any of REPORT_FIELDS), optionally only events of `event_type`.
+    Tokens and cost come from "llm" events. Time comes from one level of event so nothing is counted twice:
+    LLM calls when grouping by model, nodes when grouping by node, and whole runs otherwise.
+    Returns one row per group, slowest first.
+    """
+    timed_type = event_type or ("llm" if "model" in by else "node" if "node" in by else "request")
+    groups = defaultdict(lambda: dict.fromkeys(REPORT_TOTALS, 0))
+    for event in events:
+        if event_type and event["type"] != event_type:
+            continue
+        totals = groups[tuple(event.get(field) for field in by)]
+        if event["type"] == timed_type:
+            totals["runs"] += 1
+            totals["seconds"] += event.get("seconds", 0)
+        if event["type"] == "llm":
+            totals["llm_calls"] += 1
+            totals["cached_responses"] += bool(event.get("cached_response"))
+            for field in ("prompt_tokens", "completion_tokens", "cached_tokens"):
+                totals[field] += event.get(field) or 0
+            totals["cost"] += event.get("cost") or 0
+
+    rows = [dict(zip(by, key), **totals) for key, totals in groups.items() if totals["runs"] or totals["llm_calls"]]
+    for row in rows:
+        row["seconds"] = round(row["seconds"], 3)
+        row["cost"] = round(row["cost"], 6)
+    return sorted(rows, key=lambda row: -row["seconds"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report agent latency, tokens and cost from recorded metrics")
+    parser.add_argument("--by", default="day,node", help=f"comma-separated fields to group by, any of {', '.join(REPORT_FIELDS)}")
+    parser.add_argument("--type", choices=("request", "node", "llm"), help="only include events of this type")
+    parser.add_argument("--since", help="only include events from this day (YYYY-MM-DD) onward")
+    parser.add_argument("--format", choices=("json", "csv"), default="json")
+    parser.add_argument("--path", default=AGENT_METRICS_PATH)
+    args = parser.parse_args()
+    by = [field for field in args.by.split(",") if field]
+    unknown = [field for field in by if field not in REPORT_FIELDS]
+    if unknown:
+        parser.error(f"unknown fields: {', '.join(unknown)}")
+
+    rows = aggregate_metrics(load_metrics(args.path, args.since), by, args.type)
+    if args.format == "json":
+        print(json.dumps(rows, indent=2))
+    else:
+        writer = csv.DictWriter(sys.stdout, fieldnames=by + list(REPORT_TOTALS))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    main()
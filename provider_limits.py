@@ -0,0 +1,50 @@
+import asyncio
+import os
+import threading
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Maximum number of in-flight calls per external provider, shared by every thread in the process
+PROVIDER_LIMITS = {
+    "llm": int(os.getenv("LLM_CONCURRENCY", 8)),
+    "tavily": int(os.getenv("TAVILY_CONCURRENCY", 4)),
+    "rpc": int(os.getenv("RPC_CONCURRENCY", 4)),
+}
+
+_semaphores = {
+    provider: threading.BoundedSemaphore(limit)
+    for provider, limit in PROVIDER_LIMITS.items()
+}
+# asyncio semaphores belong to the event loop they are used on, so there is one set per loop
+_async_semaphores = weakref.WeakKeyDictionary()
+
+
+@contextmanager
+def provider_slot(provider):
+    """Block until a call slot for the given provider is free, and hold it for the duration of the block"""
+    semaphore = _semaphores[provider]
+    semaphore.acquire()
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+@asynccontextmanager
+async def async_provider_slot(provider):
+    """
+    asyncio variant of provider_slot, with the same limits applied to the calls made on the running event loop.
+    Waiters are woken in FIFO order as soon as a slot is freed, and waiting can be cancelled.
+    Sync and async callers are counted separately; each provider is only called one way (rpc from threads,
+    llm and tavily from the event loop).
+    """
+    loop = asyncio.get_running_loop()
+    semaphores = _async_semaphores.get(loop)
+    if semaphores is None:
+        semaphores = {provider: asyncio.BoundedSemaphore(limit) for provider, limit in PROVIDER_LIMITS.items()}
+        _async_semaphores[loop] = semaphores
+    async with semaphores[provider]:
+        yield
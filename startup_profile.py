@@ -0,0 +1,170 @@
+"""
+Reports cold-start cost for each entry point: how long each of its modules takes to import, the heaviest
+third-party imports behind them, and how long its lazily-created resources take to initialize.
+
+Every entry point is profiled in a fresh interpreter so results aren't skewed by modules another one already loaded.
+
+Usage:
+    python startup_profile.py                      # all entry points
+    python startup_profile.py twitter_poll --json  # one entry point, machine-readable
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Modules each entry point imports at startup, and the lazy resources it needs before doing any work
+ENTRY_POINTS = {
+    "twitter_poll": {
+        "modules": ["twitter_check"],
+        "resources": [
+            "betting_pool_generator:get_betting_pool_idea_generator_agent",
+            "betting_pool_core:get_contract",
+            "betting_pool_core:get_tx_manager",
+        ],
+    },
+    "telegram_bot": {
+        "modules": ["telegram_bot"],
+        "resources": [
+            "betting_pool_generator:get_betting_pool_idea_generator_agent",
+            "betting_pool_core:get_contract",
+            "betting_pool_core:get_tx_manager",
+        ],
+    },
+    "betting_pool_grading_cron": {
+        "modules": ["betting_pool_grading_cron"],
+        "resources": [
+            "betting_idea_grader:get_betting_pool_idea_grader_agent",
+            "betting_pool_core:get_contract",
+            "betting_pool_core:get_tx_manager",
+        ],
+    },
+    "grading_scheduler": {
+        "modules": ["grading_scheduler"],
+        "resources": [
+            "betting_idea_grader:get_betting_pool_idea_grader_agent",
+            "betting_pool_core:get_contract",
+            "betting_pool_core:get_tx_manager",
+        ],
+    },
+    "twitter_post": {
+        "modules": ["twitter_post"],
+        "resources": [],
+    },
+}
+
+TOP_IMPORTS = 10
+
+
+def profile_in_this_process(entry_point):
+    """Import the entry point's modules and initialize its resources, timing each step"""
+    import importlib
+
+    config = ENTRY_POINTS[entry_point]
+    # Modules the profiler itself loaded, excluded from the import breakdown
+    report = {"entry_point": entry_point, "modules": [], "resources": [], "preloaded": sorted(sys.modules)}
+
+    for module_name in config["modules"]:
+        started_at = time.perf_counter()
+        try:
+            importlib.import_module(module_name)
+            error = None
+        except Exception as e:
+            error = str(e)
+        report["modules"].append(
+            {"name": module_name, "seconds": time.perf_counter() - started_at, "error": error}
+        )
+
+    for resource in config["resources"]:
+        module_name, accessor_name = resource.split(":")
+        started_at = time.perf_counter()
+        try:
+            getattr(importlib.import_module(module_name), accessor_name)()
+            error = None
+        except Exception as e:
+            error = str(e)
+        report["resources"].append(
+            {"name": resource, "seconds": time.perf_counter() - started_at, "error": error}
+        )
+
+    return report
+
+
+def parse_importtime(stderr, preloaded=()):
+    """Return the top-level imports from `python -X importtime` output, slowest first"""
+    preloaded = set(preloaded)
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # Nested imports are indented under the module that triggered them
+        if name.startswith("  ") or not cumulative.strip().isdigit() or name.strip() in preloaded:
+            continue
+        imports.append({"name": name.strip(), "seconds": int(cumulative) / 1_000_000})
+    return sorted(imports, key=lambda entry: -entry["seconds"])[:TOP_IMPORTS]
+
+
+def profile(entry_point):
+    started_at = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", os.path.abspath(__file__), "--child", entry_point],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    wall_seconds = time.perf_counter() - started_at
+
+    report_lines = [line for line in result.stdout.splitlines() if line.startswith("{")]
+    if not report_lines:
+        return {"entry_point": entry_point, "error": result.stderr.strip().splitlines()[-1:]}
+
+    report = json.loads(report_lines[-1])
+    report["wall_seconds"] = wall_seconds
+    report["top_imports"] = parse_importtime(result.stderr, report.pop("preloaded"))
+    return report
+
+
+def print_report(report):
+    print(f"\n== {report['entry_point']} ==")
+    if "wall_seconds" not in report:
+        print(f"  failed to profile: {report.get('error')}")
+        return
+    print(f"  process wall time: {report['wall_seconds']:.3f}s")
+    for section in ("modules", "resources"):
+        print(f"  {section}:")
+        for entry in report[section]:
+            error = f"  (error: {entry['error']})" if entry["error"] else ""
+            print(f"    {entry['seconds']:8.3f}s  {entry['name']}{error}")
+    print("  slowest top-level imports:")
+    for entry in report["top_imports"]:
+        print(f"    {entry['seconds']:8.3f}s  {entry['name']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile cold start of each entry point")
+    parser.add_argument("entry_points", nargs="*", help=f"any of {', '.join(ENTRY_POINTS)} (default: all)")
+    parser.add_argument("--json", action="store_true", help="print the reports as JSON")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    unknown = [entry_point for entry_point in args.entry_points if entry_point not in ENTRY_POINTS]
+    if unknown:
+        parser.error(f"unknown entry points: {', '.join(unknown)}")
+
+    if args.child:
+        print(json.dumps(profile_in_this_process(args.entry_points[0])))
+        return
+
+    reports = [profile(entry_point) for entry_point in args.entry_points or ENTRY_POINTS]
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import os
+import requests
+from dotenv import load_dotenv
+from tracing import payload_size, span
+
+load_dotenv()
+
+SUBGRAPH_URL = os.getenv("SUBGRAPH_URL")
+# The Graph caps `first` at 1000
+SUBGRAPH_PAGE_SIZE = int(os.getenv("SUBGRAPH_PAGE_SIZE", 500))
+SUBGRAPH_TIMEOUT = int(os.getenv("SUBGRAPH_TIMEOUT", 30))
+# Number of pool IDs sent in a single poolIntId_in filter
+SUBGRAPH_POOL_BATCH_SIZE = int(os.getenv("SUBGRAPH_POOL_BATCH_SIZE", 100))
+
+# Every pool field the agent reads. Callers should pass only the ones they need.
+POOL_FIELDS = (
+    "id",
+    "poolIntId",
+    "status",
+    "question",
+    "options",
+    "betsCloseAt",
+    "decisionDate",
+    "closureCriteria",
+    "closureInstructions",
+    "totalBets",
+    "totalBetsByOption",
+    "xPostId",
+)
+
+
+def query_subgraph(query, variables=None):
+    """Run a GraphQL query against the subgraph and return its `data` field"""
+    body = {"query": query, "variables": variables or {}}
+    with span("subgraph.query", request_bytes=payload_size(body)) as current:
+        response = requests.post(SUBGRAPH_URL, json=body, timeout=SUBGRAPH_TIMEOUT)
+        current.set(status_code=response.status_code, response_bytes=len(response.content))
+        response.raise_for_status()
+    data = response.json()
+    if data.get("errors"):
+        raise Exception(f"Subgraph query failed: {data['errors']}")
+    return data["data"]
+
+
+def iter_entities(entity, filter_type, where, fields, page_size=SUBGRAPH_PAGE_SIZE):
+    """
+    Yield every entity matching `where`, one page at a time.
+
+    Pages are walked with an `id_gt` cursor rather than `skip`, which the subgraph
+    gets slower at the further it goes. The next page is only requested once the
+    caller has consumed the current one.
+    """
+    fields = list(fields)
+    if "id" not in fields:
+        fields.insert(0, "id")
+
+    query = f"""
+    query($where: {filter_type}!, $first: Int!) {{
+      {entity}(where: $where, first: $first, orderBy: id, orderDirection: asc) {{
+        {" ".join(fields)}
+      }}
+    }}
+    """
+
+    last_id = None
+    while True:
+        page_where = dict(where)
+        if last_id is not None:
+            page_where["id_gt"] = last_id
+
+        page = query_subgraph(query, {"where": page_where, "first": page_size})[entity]
+        yield from page
+
+        if len(page) < page_size:
+            return
+        last_id = page[-1]["id"]
+
+
+def iter_pending_pools(bets_close_before=None, fields=POOL_FIELDS, page_size=SUBGRAPH_PAGE_SIZE):
+    """
+    Yield pending pools, optionally only those whose betting closed at or before `bets_close_before` (unix seconds).
+    Raises if a page fails to load, after the pools of the pages before it have been yielded, so callers can tell
+    a failed request from the end of the pools.
+    """
+    where = {"status": "PENDING"}
+    if bets_close_before is not None:
+        # BigInt filters are passed as strings
+        where["betsCloseAt_lte"] = str(int(bets_close_before))
+
+    try:
+        yield from iter_entities("pools", "Pool_filter", where, fields, page_size)
+    except Exception as e:
+        print(f"Request for pending pools failed: {e}")
+        raise
+
+
+def fetch_pending_pools_by_id(pool_ids, fields=POOL_FIELDS, batch_size=SUBGRAPH_POOL_BATCH_SIZE):
+    """
+    Fetches the pools among `pool_ids` that are still pending. Errors are raised, so a failed request isn't mistaken
+    for the pools no longer being pending.
+    """
+    pool_ids = [str(pool_id) for pool_id in pool_ids]
+    pools = []
+    for start in range(0, len(pool_ids), batch_size):
+        where = {"status": "PENDING", "id_in": pool_ids[start : start + batch_size]}
+        pools.extend(iter_entities("pools", "Pool_filter", where, fields))
+    return pools
+
+
+def fetch_unclaimed_bets_for_pools(pool_ids, batch_size=SUBGRAPH_POOL_BATCH_SIZE):
+    """
+    Fetches the bets that haven't been paid out yet for many pools at once.
+
+    Args:
+        pool_ids (list): Pool IDs to fetch bets for
+        batch_size (int): Number of pools per poolIntId_in query
+
+    Returns:
+        dict: Mapping of pool ID (int) to the list of unclaimed bet IDs (int) in that pool
+    """
+    bets_by_pool = {int(pool_id): [] for pool_id in pool_ids}
+    unique_pool_ids = list(bets_by_pool.keys())
+
+    for i in range(0, len(unique_pool_ids), batch_size):
+        where = {
+            "poolIntId_in": unique_pool_ids[i : i + batch_size],
+            "payoutClaimed": False,
+        }
+        for bet in iter_entities("bets", "Bet_filter", where, ("betIntId", "poolIntId")):
+            bets_by_pool[int(bet["poolIntId"])].append(int(bet["betIntId"]))
+
+    print(
+        f"Found {sum(len(bet_ids) for bet_ids in bets_by_pool.values())} unclaimed bets across {len(unique_pool_ids)} pools"
+    )
+    return bets_by_pool
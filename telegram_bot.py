@@ -1,11 +1,14 @@
+import asyncio
+from collections import defaultdict
 from datetime import datetime, timedelta
 import os
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, ContextTypes
 from dotenv import load_dotenv
 from betting_pool_core import call_langgraph_agent, create_pool, generate_market_creation_tweet_content, generate_twitter_intent_url, create_pool_data, set_twitter_post_id
-from betting_pool_generator import betting_pool_idea_generator_agent
+from betting_pool_generator import get_betting_pool_idea_generator_agent
 from twitter_post import post_tweet_using_redis_token
+from tracing import start_trace
 
 # Load environment variables
 load_dotenv()
@@ -15,16 +18,25 @@ HALLUCIBETRBOT_TOKEN = os.getenv('HALLUCIBETRBOT_TOKEN')
 FRONTEND_URL_PREFIX = os.getenv('FRONTEND_URL_PREFIX')  
 LOCAL_DEV_IDENTIFIER=os.getenv('LOCAL_DEV_IDENTIFIER', "")
 GENERATE_BETTING_POOL_COMMAND = f"generate_betting_pool_idea{LOCAL_DEV_IDENTIFIER}"
+# Pool generations allowed at once across all chats, and per chat
+TELEGRAM_MAX_CONCURRENT_GENERATIONS = int(os.getenv('TELEGRAM_MAX_CONCURRENT_GENERATIONS', 4))
+TELEGRAM_MAX_CONCURRENT_PER_CHAT = int(os.getenv('TELEGRAM_MAX_CONCURRENT_PER_CHAT', 1))
+# Updates processed at once. Higher than the generation cap so commands are still answered while generations run
+TELEGRAM_CONCURRENT_UPDATES = int(os.getenv('TELEGRAM_CONCURRENT_UPDATES', 64))
+
+generation_slots = asyncio.Semaphore(TELEGRAM_MAX_CONCURRENT_GENERATIONS)
+# Number of generations in progress per chat id. Only touched from the event loop, so no lock is needed
+active_generations_per_chat = defaultdict(int)
 
 async def share_pool(update: Update, context: ContextTypes.DEFAULT_TYPE, pool_id: str, pool_data: dict):
     try:
         tweet_text = generate_market_creation_tweet_content(pool_id, pool_data, FRONTEND_URL_PREFIX)
                
         # Post the tweet to the timeline using the existing method
-        tweet_id = post_tweet_using_redis_token(tweet_text)
+        tweet_id = await asyncio.to_thread(post_tweet_using_redis_token, tweet_text)
         if tweet_id is not None:
             # Set the Twitter post ID in the contract
-            set_twitter_post_id(pool_id, tweet_id) 
+            await asyncio.to_thread(set_twitter_post_id, pool_id, tweet_id)
 
         if tweet_text:
             twitter_url = generate_twitter_intent_url(tweet_text)
@@ -40,6 +52,27 @@ async def share_pool(update: Update, context: ContextTypes.DEFAULT_TYPE, pool_id
         await update.message.reply_text(f"Error occurred: {str(e)}")
 
 async def create_pool_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    if active_generations_per_chat[chat_id] >= TELEGRAM_MAX_CONCURRENT_PER_CHAT:
+        await update.message.reply_text("Still working on a betting pool for this chat, please wait for it to finish.")
+        return
+
+    active_generations_per_chat[chat_id] += 1
+    try:
+        # Traced from here so time spent queued for a generation slot shows up too
+        with start_trace("telegram_generate_pool", update_id=update.update_id, chat_id=chat_id):
+            if generation_slots.locked():
+                await update.message.reply_text("Lots of requests right now, your betting pool is queued...")
+            async with generation_slots:
+                await generate_and_create_pool(update, context)
+    finally:
+        active_generations_per_chat[chat_id] -= 1
+        if active_generations_per_chat[chat_id] == 0:
+            del active_generations_per_chat[chat_id]
+
+
+async def generate_and_create_pool(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Generation and on-chain calls run in worker threads so the bot keeps answering other chats"""
     await update.message.reply_text("Generating betting idea...")
     message_text = update.message.text.replace(f'/{GENERATE_BETTING_POOL_COMMAND}', '').strip()
     reply_text = update.message.reply_to_message.text if update.message.reply_to_message else None
@@ -47,19 +80,24 @@ async def create_pool_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     creator_id = str(update.message.from_user.id)
     
     try:
-        langgraph_agent_response = await call_langgraph_agent(betting_pool_idea_generator_agent, message_text, reply_text)
+        langgraph_agent_response = await call_langgraph_agent(get_betting_pool_idea_generator_agent(), message_text, reply_text)
         
         # Use the new function to create pool_data
         pool_data = create_pool_data(langgraph_agent_response, creator_name, creator_id)
         
-        pool_id = create_pool(pool_data)
+        pool_id = await asyncio.to_thread(create_pool, pool_data)
         await share_pool(update, context, pool_id, pool_data)
 
     except Exception as e:
         await update.message.reply_text(str(e))
 
 def main():
-    application = Application.builder().token(HALLUCIBETRBOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(HALLUCIBETRBOT_TOKEN)
+        .concurrent_updates(TELEGRAM_CONCURRENT_UPDATES)
+        .build()
+    )
     application.add_handler(CommandHandler(GENERATE_BETTING_POOL_COMMAND, create_pool_start))
     print("Bot is starting...")
     application.run_polling()
@@ -0,0 +1,142 @@
+# Builds LLM prompt context from fetched pages within a token budget.
+#
+# Pages are split into passages, passages are ranked against the query with BM25, and the best ones are packed into
+# the budget. Kept passages are shown grouped by page, in their original order, so the context still reads naturally.
+
+from collections import Counter
+import math
+import os
+import re
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Approximate size of each passage, in words
+CONTEXT_PASSAGE_WORDS = int(os.getenv("CONTEXT_PASSAGE_WORDS", 120))
+CONTEXT_TOKENIZER_MODEL = os.getenv("CONTEXT_TOKENIZER_MODEL", "gpt-4o")
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "in", "is", "it", "its", "of", "on", "or",
+    "that", "the", "this", "to", "was", "were", "will", "with",
+}
+
+_encoding = None
+
+
+def count_tokens(text):
+    """Token count for CONTEXT_TOKENIZER_MODEL using tiktoken, or about 4 characters per token without it"""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+
+            _encoding = tiktoken.encoding_for_model(CONTEXT_TOKENIZER_MODEL)
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4
+
+
+def _terms(text):
+    return [term for term in re.findall(r"\w+", text.lower()) if term not in STOPWORDS]
+
+
+def chunk_text(text, passage_words=CONTEXT_PASSAGE_WORDS):
+    """Split text into passages of about `passage_words` words, breaking at paragraphs where possible"""
+    passages = []
+    current = []
+    for paragraph in re.split(r"\n\s*\n", text or ""):
+        words = paragraph.split()
+        while words:
+            room = passage_words - len(current)
+            current.extend(words[:room])
+            words = words[room:]
+            if len(current) >= passage_words:
+                passages.append(" ".join(current))
+                current = []
+        # Start a new passage at a paragraph break once the current one is half full
+        if len(current) >= passage_words // 2:
+            passages.append(" ".join(current))
+            current = []
+    if current:
+        passages.append(" ".join(current))
+    return passages
+
+
+def rank_passages(query, passages):
+    """BM25 score of each passage against the query, in passage order"""
+    query_terms = set(_terms(query))
+    passage_terms = [Counter(_terms(passage)) for passage in passages]
+    if not passages or not query_terms:
+        return [0.0] * len(passages)
+
+    average_length = sum(sum(terms.values()) for terms in passage_terms) / len(passages) or 1
+    document_frequency = Counter(term for terms in passage_terms for term in query_terms & terms.keys())
+    scores = []
+    for terms in passage_terms:
+        length = sum(terms.values())
+        score = 0.0
+        for term in query_terms:
+            frequency = terms.get(term, 0)
+            if not frequency:
+                continue
+            idf = math.log(1 + (len(passages) - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+            score += idf * frequency * (BM25_K1 + 1) / (
+                frequency + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+            )
+        scores.append(score)
+    return scores
+
+
+def build_context(query, documents, token_budget):
+    """
+    Pack the passages of `documents` most relevant to `query` into `token_budget` tokens.
+
+    Args:
+        query (str): What the context is for, e.g. the topic or the pool question
+        documents (list): Dicts with "content" and optionally "title" and "url"
+        token_budget (int): Max tokens of the returned context
+
+    Returns:
+        (str, dict): The context, and a report with total, kept and dropped token counts
+    """
+    passages = []
+    for document_index, document in enumerate(documents):
+        for passage_index, passage in enumerate(chunk_text(document.get("content", ""))):
+            passages.append((document_index, passage_index, passage, count_tokens(passage)))
+
+    headers = {
+        document_index: f"Title: {document.get('title', 'No title')}\nURL: {document.get('url', 'No URL')}\n"
+        for document_index, document in enumerate(documents)
+    }
+    scores = rank_passages(query, [passage for _, _, passage, _ in passages])
+
+    kept = set()
+    used_tokens = 0
+    for index in sorted(range(len(passages)), key=lambda index: -scores[index]):
+        document_index, _, _, tokens = passages[index]
+        header_tokens = 0 if any(passages[k][0] == document_index for k in kept) else count_tokens(headers[document_index])
+        if used_tokens + tokens + header_tokens > token_budget:
+            continue
+        kept.add(index)
+        used_tokens += tokens + header_tokens
+
+    sections = []
+    for document_index in range(len(documents)):
+        document_passages = [passages[index][2] for index in sorted(kept) if passages[index][0] == document_index]
+        if document_passages:
+            sections.append(headers[document_index] + "Content: " + "\n...\n".join(document_passages) + "\n")
+
+    total_tokens = sum(tokens for _, _, _, tokens in passages)
+    kept_tokens = sum(passages[index][3] for index in kept)
+    report = {
+        "total_tokens": total_tokens,
+        "kept_tokens": kept_tokens,
+        "dropped_tokens": total_tokens - kept_tokens,
+        "passages_kept": len(kept),
+        "passages_total": len(passages),
+    }
+    return "\n".join(sections), report
@@ -1,13 +1,19 @@
 from pydantic import BaseModel
-from common import smol_llm
+from common import get_cached_smol_llm
+from provider_limits import async_provider_slot
+from tools.search_cache import get_or_fetch
+from tracing import span
 import os
-import requests
+import httpx
+
+NEWS_API_TIMEOUT = int(os.getenv("NEWS_API_TIMEOUT", 15))
+
 
 class NewsSearchQuery(BaseModel):
     search_query: str
 
 
-def get_news_search_query(topic: str) -> str:
+async def get_news_search_query(topic: str) -> str:
     """Generate an optimized search query from the topic"""
     prompt = f"""
     I need to search for news articles about this topic:
@@ -26,13 +32,14 @@ def get_news_search_query(topic: str) -> str:
     }}
     """
 
-    structured_llm = smol_llm.with_structured_output(NewsSearchQuery)
-    result = structured_llm.invoke(prompt)
+    structured_llm = get_cached_smol_llm().with_structured_output(NewsSearchQuery)
+    async with async_provider_slot("llm"):
+        result = await structured_llm.ainvoke(prompt)
     return result.search_query
 
 
-def get_news_for_topic(topic: str) -> list[str]:
-    """Get relevant news articles for the topic"""
+async def get_news_for_topic(topic: str, cache_ttl=None) -> list[str]:
+    """Get relevant news articles for the topic. Results are cached per search query, see tools/search_cache.py"""
     api_key = os.getenv("NEWS_API_KEY")
     if not api_key:
         print("Warning: NEWS_API_KEY not found in environment")
@@ -40,20 +47,26 @@ def get_news_for_topic(topic: str) -> list[str]:
 
     try:
         # First get an optimized search query
-        search_query = get_news_search_query(topic)
+        search_query = await get_news_search_query(topic)
         print(f"Using search query: {search_query}")
 
-        url = f"https://newsapi.org/v2/everything?q={search_query}&apiKey={api_key}&pageSize=3"
-        print(f"Fetching news from: {url}")
-        response = requests.get(url)
-        response.raise_for_status()
-        data = response.json()
-
-        articles = data.get("articles", [])
-        return [
-            f"Title: {article['title']}\nDescription: {article['description']}"
-            for article in articles
-        ]
+        async def fetch():
+            url = f"https://newsapi.org/v2/everything?q={search_query}&apiKey={api_key}&pageSize=3"
+            print(f"Fetching news for: {search_query}")
+            with span("newsapi.everything") as current:
+                async with httpx.AsyncClient(timeout=NEWS_API_TIMEOUT) as client:
+                    response = await client.get(url)
+                current.set(status_code=response.status_code, response_bytes=len(response.content))
+                response.raise_for_status()
+            data = response.json()
+
+            articles = data.get("articles", [])
+            return [
+                f"Title: {article['title']}\nDescription: {article['description']}"
+                for article in articles
+            ]
+
+        return await get_or_fetch("newsapi", search_query, fetch, {"pageSize": 3}, cache_ttl)
     except Exception as e:
         print(f"Error fetching news: {e}")
         return []
@@ -0,0 +1,139 @@
+# Two-tier cache for search provider results (Tavily, NewsAPI), shared by the generator and the grader.
+#
+# Results are keyed by provider, normalized query and the provider options that change the response, and stored in
+# an in-process LRU and in Redis so other processes (the mention daemon, Telegram bot, grading cron) share them.
+# Each provider has a default TTL; callers that need fresher results, like the grader, pass a shorter one.
+
+from collections import Counter, OrderedDict
+import hashlib
+import json
+import os
+import threading
+import time
+from dotenv import load_dotenv
+from db.redis import get_async_redis_client
+from provider_limits import async_provider_slot
+from tracing import payload_size, span
+
+load_dotenv()
+
+SEARCH_CACHE_LRU_SIZE = int(os.getenv("SEARCH_CACHE_LRU_SIZE", 256))
+SEARCH_CACHE_USE_REDIS = os.getenv("SEARCH_CACHE_USE_REDIS", "true").lower() == "true"
+# Default TTL in seconds for each provider
+SEARCH_CACHE_TTLS = {
+    "tavily": int(os.getenv("SEARCH_CACHE_TAVILY_TTL", 1800)),
+    "newsapi": int(os.getenv("SEARCH_CACHE_NEWSAPI_TTL", 1800)),
+}
+SEARCH_CACHE_KEY_PREFIX = "search_cache:"
+
+_lru = OrderedDict()
+_lru_lock = threading.Lock()
+# Per-provider counts of memory hits, redis hits and misses
+_stats = {}
+
+
+def normalize_query(query):
+    return " ".join(str(query).lower().split())
+
+
+def cache_key(provider, query, options=None):
+    digest = hashlib.sha1(
+        json.dumps([normalize_query(query), options or {}], sort_keys=True).encode()
+    ).hexdigest()
+    return f"{SEARCH_CACHE_KEY_PREFIX}{provider}:{digest}"
+
+
+def search_cache_stats():
+    """Returns {provider: {"memory_hits", "redis_hits", "misses"}} for this process"""
+    return {provider: dict(counts) for provider, counts in _stats.items()}
+
+
+def _count(provider, outcome):
+    _stats.setdefault(provider, Counter())[outcome] += 1
+
+
+def _lru_get(key, ttl):
+    with _lru_lock:
+        entry = _lru.get(key)
+        if entry is None:
+            return None
+        fetched_at, value = entry
+        if time.time() - fetched_at > ttl:
+            return None
+        _lru.move_to_end(key)
+        return value
+
+
+def _lru_set(key, value, fetched_at):
+    with _lru_lock:
+        _lru[key] = (fetched_at, value)
+        _lru.move_to_end(key)
+        while len(_lru) > SEARCH_CACHE_LRU_SIZE:
+            _lru.popitem(last=False)
+
+
+async def get_or_fetch(provider, query, fetch, options=None, ttl=None):
+    """
+    Returns the cached result for (provider, query, options) if it was fetched less than `ttl` seconds ago
+    (default: the provider's TTL), otherwise awaits fetch() and caches what it returns.
+    Exceptions from fetch() propagate and nothing is cached. Redis errors fall back to the in-process cache.
+    """
+    ttl = SEARCH_CACHE_TTLS.get(provider, 0) if ttl is None else ttl
+    if ttl <= 0:
+        return await fetch()
+    key = cache_key(provider, query, options)
+
+    value = _lru_get(key, ttl)
+    if value is not None:
+        _count(provider, "memory_hits")
+        return value
+
+    redis_client = None
+    if SEARCH_CACHE_USE_REDIS:
+        try:
+            redis_client = get_async_redis_client()
+            cached = await redis_client.get(key)
+            if cached is not None:
+                entry = json.loads(cached)
+                if time.time() - entry["fetched_at"] <= ttl:
+                    _lru_set(key, entry["value"], entry["fetched_at"])
+                    _count(provider, "redis_hits")
+                    return entry["value"]
+        except Exception as e:
+            print(f"Error reading search cache: {str(e)}")
+
+    _count(provider, "misses")
+    value = await fetch()
+    fetched_at = time.time()
+    _lru_set(key, value, fetched_at)
+    if redis_client is not None:
+        try:
+            # Kept for the longest TTL any caller uses, so callers with a shorter TTL share the entry
+            await redis_client.set(
+                key,
+                json.dumps({"fetched_at": fetched_at, "value": value}),
+                ex=max(ttl, SEARCH_CACHE_TTLS.get(provider, 0)),
+            )
+        except Exception as e:
+            print(f"Error writing search cache: {str(e)}")
+    return value
+
+
+async def cached_tavily_search(search, query, ttl=None):
+    """Run a TavilySearchResults tool through the cache, holding a tavily provider slot only on a miss"""
+    options = {
+        option: getattr(search, option, None)
+        for option in ("max_results", "search_depth", "include_answer", "include_raw_content")
+    }
+
+    async def fetch():
+        with span("tavily.search", **options) as current:
+            async with async_provider_slot("tavily"):
+                results = await search.ainvoke(query)
+            # The tool returns errors as a string instead of raising, and those shouldn't be cached
+            if isinstance(results, str):
+                raise Exception(f"Error searching Tavily: {results}")
+            current.set(results=len(results), response_bytes=payload_size(results))
+        return results
+
+    return await get_or_fetch("tavily", query, fetch, options, ttl)
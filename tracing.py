@@ -0,0 +1,419 @@
+"""
+Lightweight tracing of the agent's external calls: web3 RPC, the subgraph, twitterapi.io, the Twitter API, Tavily
+and NewsAPI.
+
+Each call runs in a span that records its duration, status and payload size. Spans nest through a context variable,
+so a span started inside another (including in asyncio tasks and asyncio.to_thread workers) becomes its child.
+start_trace() opens the root span for one unit of work and tags it with what is being processed (a tweet ID,
+a Telegram update or a pool ID); every call made while handling it lands in the same trace.
+
+Finished spans go to TRACE_EXPORTER: "none" (the default) drops them, "file" appends them as JSON lines to TRACE_PATH
+(rotated past TRACE_FILE_MAX_BYTES), and "otlp" sends them to an OTLP/HTTP collector at TRACE_OTLP_ENDPOINT. Both
+export from a background thread, so the traced calls never wait on it. Print where time went with:
+    python tracing.py                        # critical path of the last 10 traces
+    python tracing.py --root propose_bet --last 50
+"""
+
+import argparse
+import atexit
+import contextvars
+import functools
+import inspect
+import json
+import os
+import queue
+import requests
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()
+TRACE_PATH = os.getenv("TRACE_PATH", "traces.jsonl")
+# The trace file is moved to TRACE_PATH.1 (replacing the previous one) once it grows past this many bytes
+TRACE_FILE_MAX_BYTES = int(os.getenv("TRACE_FILE_MAX_BYTES", 50 * 1024 * 1024))
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "promptbet-agent")
+# Spans sent to the collector per request, and the longest a finished span waits to be sent, in seconds
+TRACE_OTLP_BATCH_SIZE = int(os.getenv("TRACE_OTLP_BATCH_SIZE", 512))
+TRACE_OTLP_FLUSH_INTERVAL = float(os.getenv("TRACE_OTLP_FLUSH_INTERVAL", 5))
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = {key: value for key, value in attributes.items() if value is not None}
+        self.status = "ok"
+        self.error = None
+        self.start = time.time()
+        self._started_at = time.perf_counter()
+        self.duration = None
+
+    def set(self, **attributes):
+        """Add attributes, e.g. payload sizes once the response is in"""
+        self.attributes.update({key: value for key, value in attributes.items() if value is not None})
+
+    def fail(self, error):
+        """Mark the span failed, for calls that report errors without raising"""
+        self.status = "error"
+        self.error = str(error)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class _QueuedExporter(ABC):
+    """Hands items to `_send` in batches from a background thread"""
+
+    def __init__(self, batch_size, flush_interval, name):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=batch_size * 20)
+        self._send_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def export(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            # Dropping items is better than slowing down the calls being traced
+            pass
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and (timeout := deadline - time.monotonic()) > 0:
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            with self._send_lock:
+                self._send(batch)
+
+    def flush(self):
+        """Send whatever is queued, e.g. before the process exits"""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            with self._send_lock:
+                self._send(batch)
+
+    @abstractmethod
+    def _send(self, batch):
+        """Deliver one batch of items. Runs on the background thread"""
+
+
+class JsonLinesWriter(_QueuedExporter):
+    """Appends dicts as JSON lines to `path` from a background thread, moving the file to `path`.1 past max_bytes"""
+
+    def __init__(self, path, max_bytes, name="jsonl-writer"):
+        self.path = path
+        self.max_bytes = max_bytes
+        super().__init__(batch_size=512, flush_interval=1, name=name)
+
+    def write(self, record):
+        self.export(record)
+
+    def _send(self, records):
+        lines = "".join(json.dumps(record, default=str) + "\n" for record in records)
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                os.replace(self.path, f"{self.path}.1")
+            with open(self.path, "a") as output_file:
+                output_file.write(lines)
+        except Exception as e:
+            print(f"Error writing {self.path}: {str(e)}")
+
+
+class _FileExporter:
+    def __init__(self, path):
+        self._writer = JsonLinesWriter(path, TRACE_FILE_MAX_BYTES, name="trace-exporter")
+
+    def export(self, span):
+        self._writer.write(span.to_dict())
+
+
+class _OTLPExporter(_QueuedExporter):
+    """Sends spans to an OTLP/HTTP collector (JSON encoding) from a background thread"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        super().__init__(TRACE_OTLP_BATCH_SIZE, TRACE_OTLP_FLUSH_INTERVAL, name="trace-exporter")
+
+    def _send(self, spans):
+        try:
+            response = requests.post(self.endpoint, json=_otlp_payload(spans), timeout=10)
+            response.raise_for_status()
+        except Exception as e:
+            print(f"Error exporting {len(spans)} trace spans: {str(e)}")
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes):
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+
+
+def _otlp_payload(spans):
+    otlp_spans = []
+    for span in spans:
+        start_nanos = int(span.start * 1e9)
+        otlp_span = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            # Root spans are units of work, the rest are calls out to other services
+            "kind": 1 if span.parent_id is None else 3,
+            "startTimeUnixNano": str(start_nanos),
+            "endTimeUnixNano": str(start_nanos + int(span.duration * 1e9)),
+            "attributes": _otlp_attributes(span.attributes),
+            "status": {"code": 1} if span.status == "ok" else {"code": 2, "message": span.error or ""},
+        }
+        if span.parent_id:
+            otlp_span["parentSpanId"] = span.parent_id
+        otlp_spans.append(otlp_span)
+    return {
+        "resourceSpans": [
+            {
+                "resource": {"attributes": _otlp_attributes({"service.name": TRACE_SERVICE_NAME})},
+                "scopeSpans": [{"scope": {"name": "tracing"}, "spans": otlp_spans}],
+            }
+        ]
+    }
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def _get_exporter():
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                if TRACE_EXPORTER == "otlp":
+                    _exporter = _OTLPExporter(TRACE_OTLP_ENDPOINT)
+                elif TRACE_EXPORTER == "file":
+                    _exporter = _FileExporter(TRACE_PATH)
+                else:
+                    _exporter = False
+    return _exporter
+
+
+@contextmanager
+def _span(name, new_trace, attributes):
+    parent = None if new_trace else _current_span.get()
+    current = Span(
+        name,
+        parent.trace_id if parent else uuid.uuid4().hex,
+        parent.span_id if parent else None,
+        attributes,
+    )
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.error = str(e) or type(e).__name__
+        raise
+    finally:
+        current.duration = time.perf_counter() - current._started_at
+        _current_span.reset(token)
+        exporter = _get_exporter()
+        if exporter:
+            exporter.export(current)
+
+
+def span(name, **attributes):
+    """Time a call as a child of the current span, or as a trace of its own outside of one"""
+    return _span(name, False, attributes)
+
+
+def start_trace(name, **attributes):
+    """Start a new trace for one unit of work, tagged with what it processes (tweet_id=..., pool_id=...)"""
+    return _span(name, True, attributes)
+
+
+def traced(name, **attributes):
+    """Decorator that runs each call of a function or coroutine function in a span"""
+
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, **attributes):
+                    return await function(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name, **attributes):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def payload_size(payload):
+    """Size in bytes of a request or response payload as sent over the wire, roughly for JSON values"""
+    if payload is None:
+        return None
+    if isinstance(payload, (bytes, bytearray)):
+        return len(payload)
+    if isinstance(payload, str):
+        return len(payload.encode())
+    return len(json.dumps(payload, default=str))
+
+
+def trace_web3_provider(provider):
+    """Run every JSON-RPC request a web3 provider makes in a span named after its method"""
+    make_request = provider.make_request
+
+    def traced_make_request(method, params):
+        with span(f"web3.{method}", request_bytes=payload_size(params)) as current:
+            response = make_request(method, params)
+            current.set(response_bytes=payload_size(response))
+            if isinstance(response, dict) and response.get("error"):
+                current.fail(response["error"])
+            return response
+
+    provider.make_request = traced_make_request
+    return provider
+
+
+def load_traces(path=TRACE_PATH):
+    """Read exported spans, including the rotated-out file, grouped into {trace_id: [span dicts]}"""
+    traces = defaultdict(list)
+    for file_path in (f"{path}.1", path):
+        if not os.path.exists(file_path):
+            continue
+        with open(file_path) as trace_file:
+            for line in trace_file:
+                if line.strip():
+                    span_dict = json.loads(line)
+                    traces[span_dict["trace_id"]].append(span_dict)
+    return traces
+
+
+def critical_path(spans):
+    """
+    Returns [(depth, span, self seconds)] for the chain of spans that determined how long the trace took.
+    Walking back from each span's end, the child that finished last is on the path, then the child that finished
+    before that one started, and so on. Time on the path not covered by a child is the span's own.
+    """
+    span_ids = {span_dict["span_id"] for span_dict in spans}
+    children = defaultdict(list)
+    roots = []
+    for span_dict in spans:
+        if span_dict["parent_id"] in span_ids:
+            children[span_dict["parent_id"]].append(span_dict)
+        else:
+            roots.append(span_dict)
+    if not roots:
+        return []
+
+    path = []
+
+    def walk(current, depth):
+        chain = []
+        cursor = current["start"] + current["duration"]
+        for child in sorted(children[current["span_id"]], key=lambda child: -(child["start"] + child["duration"])):
+            if child["start"] + child["duration"] <= cursor + 1e-6:
+                chain.append(child)
+                cursor = child["start"]
+        entry = [depth, current, current["duration"] - sum(child["duration"] for child in chain)]
+        path.append(entry)
+        for child in reversed(chain):
+            walk(child, depth + 1)
+
+    walk(min(roots, key=lambda root: root["start"]), 0)
+    return [tuple(entry) for entry in path]
+
+
+def print_critical_path(spans):
+    path = critical_path(spans)
+    if not path:
+        return
+    root = path[0][1]
+    total = root["duration"] or 1e-9
+    tags = " ".join(f"{key}={value}" for key, value in root["attributes"].items())
+    started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(root["start"]))
+    print(f"{started}  {root['name']} {tags}  {root['duration']:.2f}s  {len(spans)} spans  trace {root['trace_id']}")
+
+    for depth, span_dict, _ in path:
+        error = f"  ERROR: {span_dict['error']}" if span_dict["status"] != "ok" else ""
+        print(
+            f"  {span_dict['duration']:8.2f}s {100 * span_dict['duration'] / total:5.1f}%  "
+            f"{'  ' * depth}{span_dict['name']}{error}"
+        )
+
+    self_time_by_name = defaultdict(float)
+    for _, span_dict, self_seconds in path:
+        self_time_by_name[span_dict["name"]] += self_seconds
+    print("  Own time on the critical path:")
+    for name, seconds in sorted(self_time_by_name.items(), key=lambda item: -item[1]):
+        print(f"  {seconds:8.2f}s {100 * seconds / total:5.1f}%  {name}")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the critical path of recorded traces")
+    parser.add_argument("--path", default=TRACE_PATH)
+    parser.add_argument("--trace-id", help="only this trace")
+    parser.add_argument("--root", help="only traces whose root span has this name, e.g. propose_bet or grade_pool")
+    parser.add_argument("--last", type=int, default=10, help="number of most recent traces to print")
+    args = parser.parse_args()
+
+    traces = load_traces(args.path)
+    if args.trace_id:
+        traces = {args.trace_id: traces.get(args.trace_id, [])}
+    selected = []
+    for spans in traces.values():
+        roots = [span_dict for span_dict in spans if span_dict["parent_id"] is None]
+        if not roots or (args.root and roots[0]["name"] != args.root):
+            continue
+        selected.append((roots[0]["start"], spans))
+    for _, spans in sorted(selected, key=lambda item: item[0])[-args.last:]:
+        print_critical_path(spans)
+
+
+if __name__ == "__main__":
+    main()
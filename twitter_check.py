@@ -4,9 +4,11 @@ from dotenv import load_dotenv
 from datetime import timezone, datetime
 from api.twitterapi.tweets import Tweet, twitterapi_get
 from betting_pool_core import call_langgraph_agent, create_pool, create_pool_data, generate_market_creation_tweet_content, set_twitter_post_id
-from betting_pool_generator import betting_pool_idea_generator_agent
+from betting_pool_generator import get_betting_pool_idea_generator_agent
 from db.redis import get_redis_client
+from db.reviewed_tweets import filter_unreviewed, mark_reviewed
 from twitter_post import post_tweet_using_redis_token
+from tracing import start_trace
 
 # Load environment variables
 load_dotenv()
@@ -17,7 +19,15 @@ FRONTEND_URL_PREFIX = os.getenv("FRONTEND_URL_PREFIX")
 LISTENER_TWITTER_HANDLE = os.getenv("LISTENER_TWITTER_HANDLE")
 POLLING_INTERVAL = int(os.getenv("POLLING_INTERVAL", 30))
 POLLING_WINDOW = int(os.getenv("POLLING_WINDOW", 3600))
+MENTION_CONCURRENCY = int(os.getenv("MENTION_CONCURRENCY", 4))
 GENERATE_BETTING_POOL_COMMAND = os.getenv("GENERATE_BETTING_POOL_COMMAND", "@CanIBetOn")
+# Upper bound on mention pages pulled in a single poll
+MENTIONS_MAX_PAGES = int(os.getenv("MENTIONS_MAX_PAGES", 10))
+# Creation time (unix seconds) of the newest mention handled, so each poll only pulls newer ones
+MENTIONS_CURSOR_KEY = f"MENTIONS_CURSOR:{LISTENER_TWITTER_HANDLE}"
+# Where a poll that hit MENTIONS_MAX_PAGES stopped: the page cursor to resume from, and the newest and oldest failed
+# mention times handled so far, which the cursor above only moves to once every page has been pulled
+MENTIONS_BACKLOG_KEY = f"MENTIONS_BACKLOG:{LISTENER_TWITTER_HANDLE}"
 # After loading environment variables, add validation
 if not all([TWITTERAPI_API_KEY, LISTENER_TWITTER_HANDLE, FRONTEND_URL_PREFIX]):
 		raise ValueError(
@@ -37,65 +47,164 @@ def pull_tweet(tweet_id):
 
 		return None
 
-def pull_tweets(handle):
+def pull_tweets(handle, since_timestamp=None, page_cursor=None):
+		"""
+		Pulls mentions newer than since_timestamp, never looking further back than POLLING_WINDOW.
+		Follows pagination from page_cursor (the first page if None) for up to MENTIONS_MAX_PAGES pages.
+		Returns (tweets, next page cursor), with a next page cursor only if older mentions are left to pull,
+		or None if any page fails, so the caller doesn't advance its cursor past tweets it never saw.
+		"""
 		review_timestamp = int(datetime.now(timezone.utc).timestamp() - POLLING_WINDOW)
+		if since_timestamp is not None:
+				review_timestamp = max(review_timestamp, int(since_timestamp))
 
 		print("reviewing since", review_timestamp)
-		url = f"{TWITTERAPI_BASE_URL}/user/mentions?userName={handle}&sinceTime={review_timestamp}"
-		
-		response = twitterapi_get(url)
-		if response:
+		base_url = f"{TWITTERAPI_BASE_URL}/user/mentions?userName={handle}&sinceTime={review_timestamp}"
+
+		tweets = []
+		cursor = page_cursor
+		for _ in range(MENTIONS_MAX_PAGES):
+				url = f"{base_url}&cursor={cursor}" if cursor else base_url
+				response = twitterapi_get(url)
+				if not response:
+						return None
 				data = response.json()
-				if data and data["tweets"]:
-						return [Tweet.from_dict(tweet) for tweet in data["tweets"]]
-				return []
-		else:
-				return None
+				if not data or not data["tweets"]:
+						return tweets, None
+				tweets.extend(Tweet.from_dict(tweet) for tweet in data["tweets"])
+				if not data.get("has_next_page") or not data.get("next_cursor"):
+						return tweets, None
+				cursor = data["next_cursor"]
+
+		# Mentions come newest first, so the ones left on later pages are older than every tweet pulled
+		return tweets, cursor
+
+
+def get_mentions_cursor(redis_client):
+		cursor = redis_client.get(MENTIONS_CURSOR_KEY)
+		return int(cursor) if cursor is not None else None
+
+
+def get_mentions_backlog(redis_client):
+		"""Returns the backlog left by a poll that hit MENTIONS_MAX_PAGES, as a dict (empty if there is none)"""
+		return redis_client.hgetall(MENTIONS_BACKLOG_KEY)
+
+
+def advance_mentions_cursor(redis_client, tweets, failed_tweets, next_page_cursor=None):
+		"""
+		Move the cursor to the newest mention seen, or to the oldest one that failed so it is pulled again next poll.
+		Tweets at the cursor second itself are pulled again and dropped by filter_unreviewed.
+		While older pages are left (next_page_cursor), the cursor stays put and the next poll resumes from that page,
+		so mentions that were never pulled aren't skipped.
+		"""
+		backlog = get_mentions_backlog(redis_client)
+		created_at = [tweet.created_at_timestamp for tweet in tweets]
+		failed_created_at = [tweet.created_at_timestamp for tweet in failed_tweets]
+		if "newest" in backlog:
+				created_at.append(float(backlog["newest"]))
+		if "oldest_failed" in backlog:
+				failed_created_at.append(float(backlog["oldest_failed"]))
+		if not created_at:
+				# Nothing pulled and no backlog, so there is nothing to move the cursor to
+				redis_client.delete(MENTIONS_BACKLOG_KEY)
+				return
+		newest = max(created_at)
+		oldest_failed = min(failed_created_at) if failed_created_at else None
+
+		if next_page_cursor:
+				backlog = {"page_cursor": next_page_cursor, "newest": newest}
+				if oldest_failed is not None:
+						backlog["oldest_failed"] = oldest_failed
+				pipeline = redis_client.pipeline()
+				pipeline.delete(MENTIONS_BACKLOG_KEY)
+				pipeline.hset(MENTIONS_BACKLOG_KEY, mapping=backlog)
+				pipeline.execute()
+				return
+
+		cursor = oldest_failed if oldest_failed is not None else newest
+		pipeline = redis_client.pipeline()
+		pipeline.set(MENTIONS_CURSOR_KEY, int(cursor))
+		pipeline.delete(MENTIONS_BACKLOG_KEY)
+		pipeline.execute()
 
 
 async def poll_tweet_mentions():
 		redis_client = get_redis_client()
-		reviewed_tweets = redis_client.smembers("reviewed_tweets")
-		tweets = pull_tweets(LISTENER_TWITTER_HANDLE)
-		if tweets is None:
+		since_timestamp = get_mentions_cursor(redis_client)
+		page_cursor = get_mentions_backlog(redis_client).get("page_cursor")
+		pulled = pull_tweets(LISTENER_TWITTER_HANDLE, since_timestamp, page_cursor)
+		if pulled is None and page_cursor:
+				# The page cursor may have expired. The time cursor hasn't moved, so starting over loses nothing
+				print("Failed to resume pulling older mentions, starting again from the newest")
+				redis_client.delete(MENTIONS_BACKLOG_KEY)
+				page_cursor = None
+				pulled = pull_tweets(LISTENER_TWITTER_HANDLE, since_timestamp)
+		if pulled is None:
 				print("Failed to fetch tweets, will retry in next polling interval")
 				return
-		if tweets == []:
+		tweets, next_page_cursor = pulled
+		if tweets == [] and not page_cursor:
 				print("No tweets found, will retry in next polling interval")
 				return
-		bets = [propose_bet(tweet_data) for tweet_data in tweets if tweet_data.tweet_id not in reviewed_tweets]
-		return asyncio.gather(*bets)
+		if next_page_cursor:
+				print(f"More than {MENTIONS_MAX_PAGES} pages of mentions, pulling the older ones next poll")
+		unreviewed_tweet_ids = set(filter_unreviewed(redis_client, [tweet_data.tweet_id for tweet_data in tweets]))
+		unreviewed_tweets = [tweet_data for tweet_data in tweets if tweet_data.tweet_id in unreviewed_tweet_ids]
+		# Process mentions concurrently, at most MENTION_CONCURRENCY at a time
+		semaphore = asyncio.Semaphore(MENTION_CONCURRENCY)
 
+		async def propose_bet_with_limit(tweet_data):
+				async with semaphore:
+						return await propose_bet(tweet_data)
 
-async def propose_bet(tweet_data: Tweet):
-		redis_client = get_redis_client()
+		results = await asyncio.gather(*[propose_bet_with_limit(tweet_data) for tweet_data in unreviewed_tweets])
+
+		# propose_bet returns None when the proposal failed
+		failed_tweets = [tweet_data for tweet_data, result in zip(unreviewed_tweets, results) if result is None]
+		advance_mentions_cursor(redis_client, tweets, failed_tweets, next_page_cursor)
+		return results
+
+
+def pull_thread_text(tweet_data: Tweet):
 		thread_text = []
 		current_tweet = tweet_data
 		while current_tweet.is_reply:
 				prior_tweet = pull_tweet(current_tweet.in_reply_to_id)
 				thread_text.append(f"@{prior_tweet.author.user_name}: {prior_tweet.text}")
 				current_tweet = prior_tweet
+		return thread_text
+
+
+async def propose_bet(tweet_data: Tweet):
+		"""
+		Generate and create a pool for a mention.
+		Blocking calls run in worker threads so other mentions can make progress meanwhile.
+		"""
+		with start_trace("propose_bet", tweet_id=tweet_data.tweet_id, author=tweet_data.author.user_name) as trace:
+			redis_client = get_redis_client()
+			try:
+					thread_text = await asyncio.to_thread(pull_thread_text, tweet_data)
+					print(f"Proposing bet for new tweet from @{tweet_data.author.user_name}: {tweet_data.text}", f"replying to thread: {"\n----------\n".join(thread_text)}" if len(thread_text) > 0 else "")
 
+					tweet_text = tweet_data.text.replace(f'{GENERATE_BETTING_POOL_COMMAND}', '').strip()
+					# Call the Langraph agent
+					langgraph_agent_response = await call_langgraph_agent(get_betting_pool_idea_generator_agent(), tweet_text, "\n----------\n".join(thread_text))
+					print(f"langgraph_agent_response: {langgraph_agent_response}")
+									# Use the new function to create pool_data
+					pool_data = create_pool_data(langgraph_agent_response, tweet_data.author.user_name, tweet_data.author.author_id)
+					pool_id = await asyncio.to_thread(create_pool, pool_data)
+					print("created pool", pool_id)
+					trace.set(pool_id=pool_id)
 
-		print(f"Proposing bet for new tweet from @{tweet_data.author.user_name}: {tweet_data.text}", f"replying to thread: {"\n----------\n".join(thread_text)}" if len(thread_text) > 0 else "")
-		try:
-				tweet_text = tweet_data.text.replace(f'{GENERATE_BETTING_POOL_COMMAND}', '').strip()
-				# Call the Langraph agent
-				langgraph_agent_response = await call_langgraph_agent(betting_pool_idea_generator_agent, tweet_text, "\n----------\n".join(thread_text))
-				print(f"langgraph_agent_response: {langgraph_agent_response}")
-								# Use the new function to create pool_data
-				pool_data = create_pool_data(langgraph_agent_response, tweet_data.author.user_name, tweet_data.author.author_id)
-				pool_id = create_pool(pool_data)
-				print("created pool", pool_id)
-
-				redis_client.sadd("reviewed_tweets", tweet_data.tweet_id)
-				quote_tweet_text = generate_market_creation_tweet_content(pool_id, pool_data, FRONTEND_URL_PREFIX)
-				timeline_post_id = post_tweet_using_redis_token(f"{quote_tweet_text}\n{tweet_data.url}")
-				if timeline_post_id is not None:
-					set_twitter_post_id(pool_id, timeline_post_id)
-				return langgraph_agent_response
-		except Exception as e:
-				print("Something went wrong with the bet proposal: ", str(e))
+					await asyncio.to_thread(mark_reviewed, redis_client, [tweet_data.tweet_id])
+					quote_tweet_text = generate_market_creation_tweet_content(pool_id, pool_data, FRONTEND_URL_PREFIX)
+					timeline_post_id = await asyncio.to_thread(post_tweet_using_redis_token, f"{quote_tweet_text}\n{tweet_data.url}")
+					if timeline_post_id is not None:
+						await asyncio.to_thread(set_twitter_post_id, pool_id, timeline_post_id)
+					return langgraph_agent_response
+			except Exception as e:
+					print("Something went wrong with the bet proposal: ", str(e))
+					trace.fail(e)
 
 if __name__ == "__main__":
 		redis_client = get_redis_client()
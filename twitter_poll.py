@@ -1,12 +1,36 @@
 import asyncio
-import time
-from db.redis import get_redis_client
+import signal
 from twitter_check import POLLING_INTERVAL, poll_tweet_mentions
 
 
+async def run_mention_daemon():
+    """
+    Poll for mentions every POLLING_INTERVAL seconds in a single long-running process, so the contract,
+    compiled graphs and Redis connections are created once instead of on every poll.
+    On SIGTERM/SIGINT, the poll in progress is allowed to finish before exiting.
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    print("Mention daemon started")
+    while not stop.is_set():
+        started_at = loop.time()
+        try:
+            await poll_tweet_mentions()
+        except Exception as e:
+            print(f"Error polling tweet mentions: {str(e)}")
+
+        # Sleep for the rest of the interval, waking up immediately on shutdown
+        try:
+            await asyncio.wait_for(
+                stop.wait(), timeout=max(POLLING_INTERVAL - (loop.time() - started_at), 0)
+            )
+        except asyncio.TimeoutError:
+            pass
+    print("Mention daemon stopped")
+
+
 if __name__ == "__main__":
-    while True:
-        redis_client = get_redis_client()
-        asyncio.run(poll_tweet_mentions())
-        # print("Waiting 1 hour before next tweet...")
-        time.sleep(POLLING_INTERVAL)  
+    asyncio.run(run_mention_daemon())
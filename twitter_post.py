@@ -1,17 +1,17 @@
 import os
 from dotenv import load_dotenv
-from db.redis import get_redis_client
+from db.redis import get_many, get_redis_client, set_many
 import requests
 from datetime import datetime, timedelta
 import base64
+from tracing import payload_size, span
 
 # Load environment variables
 load_dotenv()
 
 def get_twitter_client_vars(redis_client):
-    client_id = redis_client.get('TWITTER_CLIENT_ID')
-    client_secret = redis_client.get('TWITTER_CLIENT_SECRET')
-    return client_id, client_secret
+    client_vars = get_many(redis_client, ['TWITTER_CLIENT_ID', 'TWITTER_CLIENT_SECRET'])
+    return client_vars['TWITTER_CLIENT_ID'], client_vars['TWITTER_CLIENT_SECRET']
 
 def refresh_twitter_tokens(refresh_token):
     redis_client = get_redis_client()
@@ -31,11 +31,13 @@ def refresh_twitter_tokens(refresh_token):
         'grant_type': 'refresh_token'
     }
     
-    response = requests.post(
-        'https://api.twitter.com/2/oauth2/token',
-        headers=headers,
-        data=data
-    )
+    with span("twitter.refresh_tokens") as current:
+        response = requests.post(
+            'https://api.twitter.com/2/oauth2/token',
+            headers=headers,
+            data=data
+        )
+        current.set(status_code=response.status_code, response_bytes=len(response.content))
     
     if response.status_code != 200:
         raise Exception(f"Token refresh failed: {response.text}")
@@ -55,14 +57,16 @@ def post_tweet(access_token, message, in_reply_to_id=None):
     if in_reply_to_id:
         data.update(reply={'in_reply_to_tweet_id': in_reply_to_id})
     
-    response = requests.post(
-        'https://api.twitter.com/2/tweets',
-        headers=headers,
-        json=data
-    )
+    with span("twitter.post_tweet", request_bytes=payload_size(data), in_reply_to_id=in_reply_to_id) as current:
+        response = requests.post(
+            'https://api.twitter.com/2/tweets',
+            headers=headers,
+            json=data
+        )
+        current.set(status_code=response.status_code, response_bytes=len(response.content))
     
-    if response.status_code != 201:
-        raise Exception(f"Tweet posting failed: {response.text}")
+        if response.status_code != 201:
+            raise Exception(f"Tweet posting failed: {response.text}")
     
     return response.json()
 
@@ -78,8 +82,14 @@ def refresh_and_store_tokens(redis_client):
     
     # Store new tokens in Redis with 90-day expiration
     expiration = int(timedelta(days=90).total_seconds())
-    redis_client.set('TWITTER_ACCESS_TOKEN', new_tokens['access_token'], ex=expiration)
-    redis_client.set('TWITTER_REFRESH_TOKEN', new_tokens['refresh_token'], ex=expiration)
+    set_many(
+        redis_client,
+        {
+            'TWITTER_ACCESS_TOKEN': new_tokens['access_token'],
+            'TWITTER_REFRESH_TOKEN': new_tokens['refresh_token'],
+        },
+        ex=expiration,
+    )
     print("Successfully stored new tokens in Redis")
     
     return new_tokens['access_token']
@@ -128,8 +138,14 @@ def main():
         
         # Store new tokens in Redis with 90-day expiration
         expiration = int(timedelta(days=90).total_seconds())
-        redis_client.set('TWITTER_ACCESS_TOKEN', new_tokens['access_token'], ex=expiration)
-        redis_client.set('TWITTER_REFRESH_TOKEN', new_tokens['refresh_token'], ex=expiration)
+        set_many(
+            redis_client,
+            {
+                'TWITTER_ACCESS_TOKEN': new_tokens['access_token'],
+                'TWITTER_REFRESH_TOKEN': new_tokens['refresh_token'],
+            },
+            ex=expiration,
+        )
         print("Successfully stored new tokens in Redis")
         
         # Post tweet with current timestamp
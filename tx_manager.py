@@ -0,0 +1,324 @@
+import os
+import time
+from dataclasses import dataclass, field
+from dotenv import load_dotenv
+from db.redis import get_redis_client
+from provider_limits import provider_slot
+from tracing import span
+
+load_dotenv()
+
+GAS_LIMIT = int(os.getenv("GAS_LIMIT", 3000000))
+# Seconds to wait for a receipt before a transaction is considered stuck and re-submitted with a higher fee
+TX_RESUBMIT_AFTER = int(os.getenv("TX_RESUBMIT_AFTER", 90))
+# Seconds to wait for all receipts in a batch before giving up on the unconfirmed ones
+TX_CONFIRM_TIMEOUT = int(os.getenv("TX_CONFIRM_TIMEOUT", 600))
+TX_POLL_INTERVAL = float(os.getenv("TX_POLL_INTERVAL", 2))
+# Nodes reject a replacement transaction unless its fee is at least 10% higher
+TX_FEE_BUMP = float(os.getenv("TX_FEE_BUMP", 1.2))
+TX_MAX_RESUBMITS = int(os.getenv("TX_MAX_RESUBMITS", 5))
+# Seconds the chain's pending nonce may stay below the shared counter before the missing nonces are treated as lost
+# (allocated by a process that died before sending them) and filled with no-op transactions
+NONCE_GAP_TIMEOUT = int(os.getenv("NONCE_GAP_TIMEOUT", 300))
+
+# The counter is only ever changed by these scripts or INCR, so a compare-and-set can't interleave with an allocation
+_RAISE_NONCE_SCRIPT = """
+local stored = redis.call("GET", KEYS[1])
+if not stored or tonumber(stored) < tonumber(ARGV[1]) then
+    redis.call("SET", KEYS[1], ARGV[1])
+    return 1
+end
+return 0
+"""
+_RELEASE_NONCE_SCRIPT = """
+if tonumber(redis.call("GET", KEYS[1]) or "0") == tonumber(ARGV[1]) + 1 then
+    redis.call("SET", KEYS[1], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+
+@dataclass
+class PendingTransaction:
+    nonce: int
+    tx: dict
+    tx_hash: bytes
+    label: str = ""
+    sent_at: float = field(default_factory=time.time)
+    # Hashes of earlier fee levels for this nonce, any of which may be the one that gets mined
+    replaced_hashes: list = field(default_factory=list)
+    resubmits: int = 0
+
+
+def _is_underpriced_error(error):
+    message = str(error).lower()
+    return "underpriced" in message or "fee too low" in message
+
+
+def _is_replacement_error(error):
+    """Another transaction with the same nonce is in the mempool"""
+    return "replacement transaction underpriced" in str(error).lower()
+
+
+def _is_nonce_too_low_error(error):
+    return "nonce too low" in str(error).lower()
+
+
+def _is_already_known_error(error):
+    """This exact signed transaction is already in the mempool"""
+    return "already known" in str(error).lower()
+
+
+class TransactionManager:
+    """
+    Submits transactions for a single signer without waiting for each one to be mined.
+
+    Nonces are allocated from a Redis counter shared by every process that signs with the same key,
+    so the Telegram bot, Twitter poller and grading cron don't reuse each other's nonces.
+    """
+
+    def __init__(self, w3, account):
+        self.w3 = w3
+        self.account = account
+        self.nonce_key = f"NONCE:{account.address}"
+        self.nonce_lock_key = f"NONCE_LOCK:{account.address}"
+        # When the chain's pending nonce was first seen below the counter, and the counter at that time
+        self.nonce_gap_key = f"NONCE_GAP:{account.address}"
+        self._chain_id = None
+
+    @property
+    def chain_id(self):
+        if self._chain_id is None:
+            with provider_slot("rpc"):
+                self._chain_id = self.w3.eth.chain_id
+        return self._chain_id
+
+    def _chain_pending_nonce(self):
+        with provider_slot("rpc"):
+            return self.w3.eth.get_transaction_count(self.account.address, "pending")
+
+    def sync_nonce(self):
+        """
+        Raise the shared nonce counter to the chain's pending nonce if the chain is ahead of it.
+        If the chain stays behind it for NONCE_GAP_TIMEOUT, fill the nonces no transaction was ever sent with.
+        """
+        chain_nonce = self._chain_pending_nonce()
+        redis_client = get_redis_client()
+        try:
+            redis_client.eval(_RAISE_NONCE_SCRIPT, 1, self.nonce_key, chain_nonce)
+            gap_end = self._expired_nonce_gap(redis_client, chain_nonce)
+        finally:
+            redis_client.close()
+        if gap_end is not None:
+            self._fill_nonce_gap(chain_nonce, gap_end)
+
+    def _expired_nonce_gap(self, redis_client, chain_nonce):
+        """
+        Track how long the chain's pending nonce has been stuck below the counter. Once that's longer than
+        NONCE_GAP_TIMEOUT, returns the counter from when it was first seen: every nonce below it had been allocated
+        for at least the timeout. Otherwise returns None.
+        """
+        with redis_client.lock(self.nonce_lock_key, timeout=30, blocking_timeout=30):
+            counter = int(redis_client.get(self.nonce_key) or 0)
+            if chain_nonce >= counter:
+                redis_client.delete(self.nonce_gap_key)
+                return None
+            gap = redis_client.hgetall(self.nonce_gap_key)
+            if not gap or int(gap["nonce"]) != chain_nonce:
+                # New gap, or the chain moved on since the last check
+                redis_client.hset(
+                    self.nonce_gap_key, mapping={"nonce": chain_nonce, "counter": counter, "since": time.time()}
+                )
+                return None
+            if time.time() - float(gap["since"]) < NONCE_GAP_TIMEOUT:
+                return None
+            redis_client.delete(self.nonce_gap_key)
+            return int(gap["counter"])
+
+    def _fill_nonce_gap(self, nonce, gap_end):
+        """Send no-ops for the nonces missing from the chain, from `nonce` up to at most `gap_end`"""
+        while nonce < gap_end:
+            print(f"Nonce {nonce} was allocated but never sent, filling it with a no-op transaction")
+            try:
+                self._send_noop(nonce)
+                # The node now also picks up the transactions queued behind the no-op, up to the next missing nonce
+                nonce = max(self._chain_pending_nonce(), nonce + 1)
+            except Exception as e:
+                print(f"Error filling nonce gap {nonce}, later transactions may be stuck until it's used: {str(e)}")
+                return
+
+    def allocate_nonce(self):
+        redis_client = get_redis_client()
+        try:
+            if not redis_client.exists(self.nonce_key):
+                self.sync_nonce()
+            # INCR is atomic, so concurrent processes always get distinct nonces
+            return redis_client.incr(self.nonce_key) - 1
+        finally:
+            redis_client.close()
+
+    def release_nonce(self, nonce):
+        """
+        Give back a nonce whose transaction never reached the mempool.
+        If another nonce was allocated after it, fill the gap with a no-op so later transactions aren't stuck behind it.
+        Failures are printed rather than raised, so the caller re-raises the error that made it give the nonce back.
+        """
+        redis_client = get_redis_client()
+        try:
+            if redis_client.eval(_RELEASE_NONCE_SCRIPT, 1, self.nonce_key, nonce):
+                return
+        except Exception as e:
+            print(f"Error releasing nonce {nonce}: {str(e)}")
+            return
+        finally:
+            redis_client.close()
+
+        print(f"Filling nonce gap {nonce} with a no-op transaction")
+        try:
+            self._send_noop(nonce)
+        except Exception as e:
+            print(f"Error filling nonce gap {nonce}, later transactions may be stuck until it's used: {str(e)}")
+
+    def _send_noop(self, nonce):
+        """Use up a nonce with a zero-value transfer to ourselves"""
+        with provider_slot("rpc"):
+            gas_price = self.w3.eth.gas_price
+        noop_tx = {
+            "from": self.account.address,
+            "to": self.account.address,
+            "value": 0,
+            "nonce": nonce,
+            "gas": 21000,
+            "gasPrice": gas_price,
+            "chainId": self.chain_id,
+        }
+        return self._send_signed(noop_tx)
+
+    def _send_signed(self, tx, replacing=False):
+        """
+        Sign and broadcast a transaction, bumping its fee until the node accepts it.
+        Unless `replacing` one of our own transactions, a nonce already taken in the mempool is raised rather than
+        outbid, so another process's transaction is never replaced.
+        """
+        for _ in range(TX_MAX_RESUBMITS + 1):
+            signed_tx = self.account.sign_transaction(tx)
+            try:
+                with provider_slot("rpc"):
+                    return tx, self.w3.eth.send_raw_transaction(signed_tx.raw_transaction)
+            except Exception as e:
+                if _is_already_known_error(e):
+                    # Sent already, e.g. by a retried request whose first response was lost
+                    return tx, signed_tx.hash
+                if not _is_underpriced_error(e) or (_is_replacement_error(e) and not replacing):
+                    raise
+                tx = {**tx, "gasPrice": int(tx["gasPrice"] * TX_FEE_BUMP)}
+                print(f"Transaction with nonce {tx['nonce']} underpriced, retrying with gas price {tx['gasPrice']}")
+        raise Exception(f"Transaction with nonce {tx['nonce']} still underpriced after {TX_MAX_RESUBMITS} fee bumps")
+
+    def submit(self, contract_function, gas=None, label=""):
+        """Build, sign and broadcast a contract call without waiting for it to be mined"""
+        with span("tx.submit", label=label) as current:
+            for _ in range(2):
+                nonce = self.allocate_nonce()
+                try:
+                    with provider_slot("rpc"):
+                        tx = contract_function.build_transaction(
+                            {
+                                "from": self.account.address,
+                                "nonce": nonce,
+                                "gas": gas or GAS_LIMIT,
+                                "gasPrice": self.w3.eth.gas_price,
+                            }
+                        )
+                    tx, tx_hash = self._send_signed(tx)
+                    current.set(nonce=nonce)
+                    print(f"Submitted transaction {label} with nonce {nonce}: {tx_hash.hex()}")
+                    return PendingTransaction(nonce=nonce, tx=tx, tx_hash=tx_hash, label=label)
+                except Exception as e:
+                    if _is_nonce_too_low_error(e) or _is_replacement_error(e):
+                        # Another signer used this nonce outside of the shared counter, so resync and try once more
+                        print(f"Nonce {nonce} already used, resyncing with the chain")
+                        self.sync_nonce()
+                        continue
+                    self.release_nonce(nonce)
+                    raise
+            raise Exception(f"Could not allocate a fresh nonce for transaction {label}")
+
+    def _get_receipt(self, pending):
+        for tx_hash in [pending.tx_hash] + pending.replaced_hashes:
+            try:
+                with provider_slot("rpc"):
+                    receipt = self.w3.eth.get_transaction_receipt(tx_hash)
+            except Exception:
+                # Not mined yet (web3 raises TransactionNotFound)
+                continue
+            if receipt is not None:
+                return receipt
+        return None
+
+    def _resubmit(self, pending):
+        """Replace a stuck or dropped transaction with the same nonce and a higher fee"""
+        with provider_slot("rpc"):
+            gas_price = max(int(pending.tx["gasPrice"] * TX_FEE_BUMP), self.w3.eth.gas_price)
+        try:
+            tx, tx_hash = self._send_signed({**pending.tx, "gasPrice": gas_price}, replacing=True)
+        except Exception as e:
+            if _is_nonce_too_low_error(e):
+                # One of the earlier fee levels was mined in the meantime
+                return
+            raise
+        print(f"Re-submitted transaction {pending.label} with nonce {pending.nonce} and gas price {gas_price}: {tx_hash.hex()}")
+        pending.replaced_hashes.append(pending.tx_hash)
+        pending.tx = tx
+        pending.tx_hash = tx_hash
+        pending.sent_at = time.time()
+        pending.resubmits += 1
+
+    def wait_for_receipts(self, pending_transactions, timeout=TX_CONFIRM_TIMEOUT):
+        """
+        Poll for receipts of all pending transactions at once, re-submitting any that stay unmined for too long.
+        Returns the receipts in the same order, with None for transactions that didn't confirm within the timeout.
+        """
+        with span("tx.wait_for_receipts", transactions=len(pending_transactions)) as current:
+            receipts = [None] * len(pending_transactions)
+            deadline = time.time() + timeout
+            gap_checked_at = time.time()
+            while time.time() < deadline:
+                unconfirmed = [i for i, receipt in enumerate(receipts) if receipt is None]
+                if not unconfirmed:
+                    break
+                for i in unconfirmed:
+                    pending = pending_transactions[i]
+                    receipts[i] = self._get_receipt(pending)
+                    if receipts[i] is not None:
+                        continue
+                    if time.time() - pending.sent_at > TX_RESUBMIT_AFTER and pending.resubmits < TX_MAX_RESUBMITS:
+                        try:
+                            self._resubmit(pending)
+                        except Exception as e:
+                            print(f"Error re-submitting transaction {pending.label} with nonce {pending.nonce}: {str(e)}")
+                if any(receipt is None for receipt in receipts):
+                    if time.time() - gap_checked_at > TX_RESUBMIT_AFTER:
+                        # Transactions stuck this long may be queued behind a nonce that was never sent
+                        gap_checked_at = time.time()
+                        try:
+                            self.sync_nonce()
+                        except Exception as e:
+                            print(f"Error checking for nonce gaps: {str(e)}")
+                    time.sleep(TX_POLL_INTERVAL)
+
+            current.set(unconfirmed=sum(receipt is None for receipt in receipts))
+
+        for pending, receipt in zip(pending_transactions, receipts):
+            if receipt is None:
+                print(f"Transaction {pending.label} with nonce {pending.nonce} was not confirmed: {pending.tx_hash.hex()}")
+        return receipts
+
+    def transact(self, contract_function, gas=None, label=""):
+        """Submit a contract call and block until it is mined"""
+        pending = self.submit(contract_function, gas=gas, label=label)
+        receipt = self.wait_for_receipts([pending])[0]
+        if receipt is None:
+            raise Exception(f"Transaction {pending.tx_hash.hex()} was not confirmed")
+        return receipt